@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Cost of echo suppression with EchoCache against the ReceivedQueue which
+# IRKitHost used before, with signals of realistic sizes. The number of echoes
+# which were not suppressed is reported as well.
+#   python benchmarks/bench_echo.py
+
+import os
+import random
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'mqttadapters'))
+from irkit import EchoCache
+
+ROUNDS = 200
+BURST = 8
+
+
+# The implementation replaced by EchoCache, as it was
+class ReceivedQueue(object):
+
+    items = []
+
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.size = size
+
+    def put(self, item):
+        with self.lock:
+            self.items.append(item)
+            if len(self.items) > self.size:
+                del self.items[-1]
+
+    def has(self, item):
+        with self.lock:
+            if item in self.items:
+                found = self.items.index(item)
+                del self.items[found]
+                return True
+            else:
+                return False
+
+
+def get_signal(rand, length):
+    return {'format': 'raw', 'freq': 38,
+            'data': [rand.randint(100, 20000) for i in range(length)]}
+
+
+def measure(cache, rounds):
+    # Returns the time per operation and the number of missed echoes
+    missed = [0]
+
+    def run():
+        for received, echoes, others in rounds:
+            for signal in received:
+                cache.put(signal)
+            for signal in echoes:
+                if not cache.has(signal):
+                    missed[0] += 1
+            for signal in others:
+                cache.has(signal)
+    elapsed = timeit.timeit(run, number=1)
+    operations = sum([len(r) + len(e) + len(o) for r, e, o in rounds])
+    return elapsed / operations, missed[0]
+
+
+def main():
+    rand = random.Random(1)
+    for length in [100, 400, 1000]:
+        # Busy traffic: several signals are received before their echoes
+        # come back from the messages topic, and other signals are sent.
+        # Echoes are copies decoded from MQTT messages.
+        rounds = []
+        for i in range(ROUNDS):
+            received = [get_signal(rand, length) for j in range(BURST)]
+            echoes = [dict(s, data=list(s['data'])) for s in received]
+            others = []
+            for s in received:
+                other = dict(s, data=list(s['data']))
+                other['data'][-1] += 1
+                others.append(other)
+            rounds.append((received, echoes, others))
+        results = []
+        del ReceivedQueue.items[:]
+        for cache in [ReceivedQueue(5), EchoCache(64)]:
+            elapsed, missed = measure(cache, rounds)
+            results.append('%s %7.2f us/op, %4d/%d echoes missed' %
+                           (cache.__class__.__name__, elapsed * 1e6,
+                            missed, ROUNDS * BURST))
+        print('%4d durations: %s' % (length, '; '.join(results)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Latency of sends to a local fake IRKit, with a new session per request as
+# IRKitHost used to do, and with the keep-alive session of IRKitHost. The
+# fake IRKit is slow to accept connections like the ESP-class devices.
+#   python benchmarks/bench_irkit_send.py
+
+import json
+import os
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'mqttadapters'))
+import requests
+from irkit import IRKitHost, SignalLibrary
+
+SENDS = 50
+ACCEPT_DELAY_SEC = 0.02
+SIGNAL = {'format': 'raw', 'freq': 38,
+          'data': [18031, 8755] + [1190, 1190, 1190, 3341] * 32 + [1190]}
+
+
+class FakeIRKit(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def get_request(self):
+        request = HTTPServer.get_request(self)
+        time.sleep(ACCEPT_DELAY_SEC)
+        return request
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # The response is written at once like a real IRKit; separate writes of
+    # the headers would be delayed by Nagle's algorithm on keep-alive
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NullClient(object):
+
+    def publish(self, topic, payload=None, **kwargs):
+        pass
+
+
+class NullPoller(object):
+
+    def wake(self, host):
+        pass
+
+
+def measure(send):
+    latencies = []
+    for i in range(SENDS):
+        started = time.time()
+        send()
+        latencies.append(time.time() - started)
+    latencies.sort()
+    return (sum(latencies) / len(latencies) * 1000,
+            latencies[len(latencies) * 95 / 100] * 1000)
+
+
+def main():
+    server = FakeIRKit(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_address[1]
+    url = 'http://127.0.0.1:%d/messages' % port
+
+    def send_with_new_session():
+        session = requests.Session()
+        session.post(url, data=json.dumps(SIGNAL), timeout=5.0)
+        session.close()
+
+    host = IRKitHost('bench', u'127.0.0.1', port, NullClient(),
+                     SignalLibrary(None), NullPoller())
+    print('%d sends, accept delay %d ms' % (SENDS, ACCEPT_DELAY_SEC * 1000))
+    print('new session per send: avg %6.2f ms, p95 %6.2f ms' %
+          measure(send_with_new_session))
+    print('keep-alive session:   avg %6.2f ms, p95 %6.2f ms' %
+          measure(lambda: host.post(SIGNAL)))
+    server.shutdown()
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
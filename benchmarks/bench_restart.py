@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Time from the start of mqtt-hue and mqtt-irkit until a known device can be
+# controlled, with and without the device cache. Discovery is simulated: the
+# SSDP response arrives after 2 seconds (the timeout of the discovery used
+# before) and the description is served locally, and zeroconf resolves IRKits
+# after 1 second.
+#   python benchmarks/bench_restart.py
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'mqttadapters'))
+import hue
+import irkit
+from common import DeviceCache
+
+SSDP_DELAY_SEC = 2.0
+ZEROCONF_DELAY_SEC = 1.0
+UDN = 'uuid:2f402f80-da50-11e1-9b23-001788102201'
+IRKIT_NAME = u'IRKitD2A4._irkit._tcp.local.'
+DESCRIPTION = '''<?xml version="1.0"?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+<URLBase>http://127.0.0.1:80/</URLBase>
+<device>
+<friendlyName>Philips hue (127.0.0.1)</friendlyName>
+<modelName>Philips hue bridge 2015</modelName>
+<UDN>%s</UDN>
+</device>
+</root>''' % UDN
+
+
+class DescriptionHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.end_headers()
+        self.wfile.write(DESCRIPTION)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NullClient(object):
+
+    def publish(self, topic, payload=None, **kwargs):
+        pass
+
+
+class FakeBridge(object):
+
+    def __init__(self, ip):
+        self.username = 'user'
+
+    def connect(self):
+        pass
+
+    def get_api(self):
+        return {}
+
+    def get_light(self):
+        return {}
+
+
+class FakeResponse(object):
+
+    def __init__(self, location):
+        self.location = location
+        self.usn = UDN + '::upnp:rootdevice'
+
+    def get_max_age(self):
+        return 100
+
+
+def fake_listener(location):
+    class FakeListener(object):
+
+        def __init__(self, service, on_event, **kwargs):
+            self.on_event = on_event
+
+        def start(self):
+            timer = threading.Timer(SSDP_DELAY_SEC, self.on_event,
+                                    ['alive', FakeResponse(location)])
+            timer.daemon = True
+            timer.start()
+
+        def inactivate(self):
+            pass
+    return FakeListener
+
+
+class FakeZeroconf(object):
+
+    def get_service_info(self, type, name):
+        time.sleep(ZEROCONF_DELAY_SEC)
+
+        class Info(object):
+            address = '\x0a\x00\x00\x02'
+            port = 80
+        return Info()
+
+
+def wait_until(condition):
+    started = time.time()
+    while not condition():
+        time.sleep(0.001)
+    return time.time() - started
+
+
+def measure_hue(path):
+    started = time.time()
+    browser = hue.DeviceBrowser(NullClient(), cache=DeviceCache(path),
+                               use_eventstream=False)
+    browser.devices = {}
+    browser.start()
+    wait_until(lambda: browser.router.lookup(hue.get_topic(UDN) +
+                                             '/light/1/status')[0])
+    elapsed = time.time() - started
+    wait_until(lambda: browser.cache.get(UDN))
+    browser.inactivate()
+    for dev in browser.devices.values():
+        dev['bridge'].inactivate()
+        dev['bridge'].join()
+    browser.join()
+    return elapsed
+
+
+def measure_irkit(path):
+    started = time.time()
+    listener = irkit.HostListener(NullClient(), cache=DeviceCache(path))
+    listener.hosts = {}
+    listener.load_cache()
+    listener.add_service(FakeZeroconf(), irkit.SERVICE_TYPE, IRKIT_NAME)
+    wait_until(lambda: listener.router.get(
+        irkit.get_messages_topic(IRKIT_NAME)))
+    elapsed = time.time() - started
+    wait_until(lambda: listener.cache.get(IRKIT_NAME))
+    for host in listener.hosts.values():
+        host.inactivate()
+    return elapsed
+
+
+def main():
+    server = HTTPServer(('127.0.0.1', 0), DescriptionHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    location = 'http://127.0.0.1:%d/description.xml' % server.server_port
+    hue.ssdp.SSDPListener = fake_listener(location)
+    hue.Bridge = FakeBridge
+    irkit.IRKitHost.poll_once = lambda self: None
+
+    workdir = tempfile.mkdtemp()
+    try:
+        hue_cache = os.path.join(workdir, 'hue.json')
+        irkit_cache = os.path.join(workdir, 'irkit.json')
+        # The first start fills the caches
+        print('hue   without cache: %6.3f s' % measure_hue(hue_cache))
+        print('hue   with cache:    %6.3f s' % measure_hue(hue_cache))
+        print('irkit without cache: %6.3f s' % measure_irkit(irkit_cache))
+        print('irkit with cache:    %6.3f s' % measure_irkit(irkit_cache))
+    finally:
+        shutil.rmtree(workdir)
+        server.shutdown()
+
+if __name__ == '__main__':
+    main()
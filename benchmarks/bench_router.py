@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Dispatch cost of TopicRouter against the scan over all devices which
+# DeviceBrowser.on_message used to do, with 10k simulated devices.
+#   python benchmarks/bench_router.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'mqttadapters'))
+from common import TopicRouter
+
+DEVICES = 10000
+MESSAGES = 10000
+
+
+def main():
+    topics = ['hue/%08x-da50-11e1-9b23-001788102201' % i
+              for i in range(DEVICES)]
+    devices = dict([(t, {'topic': t}) for t in topics])
+    router = TopicRouter()
+    for topic, dev in devices.items():
+        router.add(topic, dev)
+    messages = [topics[(i * 7919) % DEVICES] + '/light/3/status'
+                for i in range(MESSAGES)]
+
+    def scan():
+        for msg in messages:
+            for dev in devices.values():
+                if msg.startswith(dev['topic']):
+                    break
+
+    def route():
+        for msg in messages:
+            router.lookup(msg)
+
+    scanned = timeit.timeit(scan, number=1)
+    routed = timeit.timeit(route, number=1)
+    print('%d devices, %d messages' % (DEVICES, MESSAGES))
+    print('scan:   %8.2f us/message' % (scanned / MESSAGES * 1e6))
+    print('router: %8.2f us/message' % (routed / MESSAGES * 1e6))
+
+if __name__ == '__main__':
+    main()
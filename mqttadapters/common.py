@@ -1,7 +1,14 @@
+import json
 import logging
+import os
+import Queue
 import ssl
+import sys
+import threading
+import time
 
 LOG_FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+DEFAULT_CACHE_DIR = os.path.expanduser('~/.mqtt-adapters')
 
 def add_mqtt_arguments(parser, topic_default):
     parser.add_argument('-H', '--host', type=str, dest='host',
@@ -24,6 +31,16 @@ def add_mqtt_arguments(parser, topic_default):
                         help='quiet mode(log level=warn)')
 
 
+def add_cache_arguments(parser, name):
+    cache_default = os.path.join(DEFAULT_CACHE_DIR, name + '.json')
+    parser.add_argument('--cache', type=str, dest='cache',
+                        default=cache_default,
+                        help='path to the cache of discovered devices'
+                             '(default: {})'.format(cache_default))
+    parser.add_argument('--no-cache', dest='cache', action='store_const',
+                        const=None, help='do not cache discovered devices')
+
+
 def connect_mqtt(args, client):
     if args.username is not None:
         if args.password is not None:
@@ -42,3 +59,199 @@ def get_log_level(args):
         return logging.WARN
     else:
         return logging.INFO
+
+
+# Index of values keyed by the segments of their topics, so that the cost of
+# a lookup depends on the depth of the topic, not on the number of topics
+class TopicRouter(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.root = {}
+        self.entries = {}
+
+    def add(self, topic, value):
+        with self.lock:
+            node = self.root
+            for segment in topic.split('/'):
+                node = node.setdefault(segment, {})
+            node[None] = value
+            self.entries[topic] = value
+
+    def remove(self, topic):
+        with self.lock:
+            if topic not in self.entries:
+                return
+            del self.entries[topic]
+            path = [self.root]
+            segments = topic.split('/')
+            for segment in segments:
+                path.append(path[-1][segment])
+            del path[-1][None]
+            # Prune the nodes which no longer lead to any value
+            for i in reversed(range(len(segments))):
+                if path[i + 1]:
+                    break
+                del path[i][segments[i]]
+
+    def lookup(self, topic):
+        # Returns the value of the longest registered prefix of the topic
+        # and the remaining segments, or (None, None)
+        with self.lock:
+            node = self.root
+            segments = topic.split('/')
+            found = (None, None)
+            for i, segment in enumerate(segments):
+                if segment not in node:
+                    break
+                node = node[segment]
+                if None in node:
+                    found = (node[None], segments[i + 1:])
+            return found
+
+    def get(self, topic):
+        with self.lock:
+            return self.entries.get(topic)
+
+    def values(self):
+        with self.lock:
+            return self.entries.values()
+
+
+# Discovered devices persisted as a JSON file, so that an adapter can
+# control known devices right after a restart. The path can be None to
+# disable the cache.
+class DeviceCache(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except (IOError, ValueError):
+                logging.getLogger().warning('Broken cache: %s' % path)
+
+    def items(self):
+        with self.lock:
+            return [(k, dict(v)) for k, v in self.entries.items()]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return dict(entry) if entry is not None else None
+
+    def put(self, key, entry):
+        with self.lock:
+            if self.entries.get(key) == entry:
+                return
+            self.entries[key] = dict(entry)
+            self._save()
+
+    def remove(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return
+            del self.entries[key]
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        try:
+            dirname = os.path.dirname(self.path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            logging.getLogger().warning('Failed to save the cache: %s'
+                                        % self.path)
+
+
+# Runs commands on worker threads instead of the network thread of paho.
+# Commands with the same key run in order on the same worker, and commands
+# with different keys can run in parallel. When the queue of a worker is
+# full, the oldest command is dropped ('drop-oldest') or the new one is
+# ('drop-new'), and on_drop(key, func, args) is called with the dropped one.
+class Dispatcher(object):
+
+    def __init__(self, workers=4, queue_size=32, overflow='drop-oldest',
+                 on_error=None, on_drop=None):
+        assert overflow in ('drop-oldest', 'drop-new')
+        self.overflow = overflow
+        self.on_error = on_error
+        self.on_drop = on_drop
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.queues = [Queue.Queue(queue_size) for _ in range(workers)]
+        for q in self.queues:
+            worker = threading.Thread(target=self._work, args=(q,))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, key, func, *args):
+        q = self.queues[hash(key) % len(self.queues)]
+        while True:
+            try:
+                q.put_nowait((key, func, args))
+                return True
+            except Queue.Full:
+                pass
+            if self.overflow == 'drop-new':
+                self._on_dropped(key, func, args)
+                return False
+            try:
+                old_key, old_func, old_args = q.get_nowait()
+                q.task_done()
+                self._on_dropped(old_key, old_func, old_args)
+            except Queue.Empty:
+                pass
+
+    def depth(self):
+        return sum([q.qsize() for q in self.queues])
+
+    def stats(self):
+        with self.lock:
+            dropped = self.dropped
+        return {'depth': self.depth(), 'dropped': dropped}
+
+    def publish_stats(self, mqtt_client, topic, interval=60.0):
+        def _publish():
+            while True:
+                time.sleep(interval)
+                mqtt_client.publish(topic, payload=json.dumps(self.stats()))
+        publisher = threading.Thread(target=_publish)
+        publisher.daemon = True
+        publisher.start()
+
+    def _on_dropped(self, key, func, args):
+        with self.lock:
+            self.dropped += 1
+            dropped = self.dropped
+        logging.getLogger().warning('Dropped a command for %s (dropped=%d, '
+                                    'depth=%d)' % (key, dropped,
+                                                   self.depth()))
+        if self.on_drop is not None:
+            try:
+                self.on_drop(key, func, args)
+            except:
+                logging.getLogger().error('Unexpected error: %s' %
+                                          sys.exc_info()[0])
+
+    def _work(self, q):
+        while True:
+            key, func, args = q.get()
+            try:
+                func(*args)
+            except:
+                logging.getLogger().error('Unexpected error: %s' %
+                                          sys.exc_info()[0])
+                if self.on_error is not None:
+                    self.on_error(key, sys.exc_info())
+            finally:
+                q.task_done()
@@ -3,12 +3,17 @@
 
 import threading
 import time
+import heapq
 import sys
 import grovepi
 import paho.mqtt.client as mqtt
 import logging
 import logging.config
 import json
+import mmap
+import os
+import struct
+from collections import deque
 from argparse import ArgumentParser
 from common import *
 from socket import gethostname
@@ -16,8 +21,12 @@ from socket import gethostname
 DEFAULT_TOPIC_BASE = 'grovepi/'
 CHECK_INTERVAL_SEC = 1.0
 MAX_INTERVAL = 60 * 10
+STATS_INTERVAL_SEC = 60.0
+DEFAULT_HISTORY_SIZE = 8192
+MAX_HISTORY_POINTS = 1000
 
 topic_base = DEFAULT_TOPIC_BASE
+history_dir = None
 logger = logging.getLogger()
 
 DEFAULT_LIGHT_SENSOR = 0
@@ -31,127 +40,504 @@ def get_topic(name):
         return topic_base + name.encode('utf8')
 
 
-class GrovePiHost(threading.Thread):
+class MedianFilter(object):
 
-    def __init__(self, name, mqtt_client):
-        super(GrovePiHost, self).__init__()
-        self.name = name
-        self.mqtt_client = mqtt_client
-        self.closed = False
-        self.started = False
-        self.lock = threading.RLock()
+    def __init__(self, size=5):
+        self.values = deque(maxlen=size)
+
+    def put(self, value):
+        self.values.append(value)
+        ordered = sorted(self.values)
+        return ordered[len(ordered) // 2]
+
+
+class EMAFilter(object):
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.value = None
+
+    def put(self, value):
+        if self.value is None:
+            self.value = float(value)
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+
+# Filtered samples are aggregated over a window, and the aggregate is
+# published only if its mean moved by the deadband or MAX_INTERVAL passed
+class Pipeline(object):
+
+    def __init__(self, filter=None, filter_size=5, alpha=0.3, window=0.0,
+                 deadband=10):
+        if filter == 'median':
+            self.filter = MedianFilter(filter_size)
+        elif filter == 'ema':
+            self.filter = EMAFilter(alpha)
+        elif filter is None:
+            self.filter = None
+        else:
+            raise ValueError('Unknown filter: {}'.format(filter))
+        self.window = window
+        self.deadband = deadband
         self.lastValue = None
         self.lastTime = None
+        self._reset(None)
+
+    def put(self, value, now):
+        if self.filter is not None:
+            value = self.filter.put(value)
+        if self.start is None:
+            self._reset(now)
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.sum += value
+        self.count += 1
+        if self.start + self.window > now:
+            return None
+        aggregate = {'min': self.min, 'max': self.max,
+                     'mean': float(self.sum) / self.count,
+                     'count': self.count}
+        self._reset(None)
+        if not self._is_changed(aggregate['mean'], now):
+            return None
+        return aggregate
 
-    def on_connect(self, client, userdata, flags, rc):
-        logger.info('Connected rc=%d' % rc)
-        if not self.started:
-            self.started = True
-            self.start()
+    def _reset(self, now):
+        self.start = now
+        self.min = None
+        self.max = None
+        self.sum = 0
+        self.count = 0
+
+    def _is_changed(self, value, now):
+        if self.lastValue is not None and \
+            self.lastTime is not None and \
+            self.lastTime + MAX_INTERVAL > now and \
+            abs(self.lastValue - value) < self.deadband:
+            return False
+        self.lastTime = now
+        self.lastValue = value
+        return True
+
+
+# Fixed-size ring buffer of (time, value) samples. The slots live in a
+# bytearray, or in a file mapped by mmap so that they survive restarts
+class SampleHistory(object):
+
+    HEADER = struct.Struct('<4sIII')
+    SLOT = struct.Struct('<dd')
+    MAGIC = 'GRH1'
+
+    def __init__(self, size=DEFAULT_HISTORY_SIZE, path=None):
+        self.size = size
+        self.lock = threading.Lock()
+        self.file = None
+        length = self.HEADER.size + self.SLOT.size * size
+        if path is None:
+            self.buf = bytearray(length)
+        else:
+            dirname = os.path.dirname(path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+            self.file.truncate(length)
+            self.buf = mmap.mmap(self.file.fileno(), length)
+        magic, size, self.head, self.count = \
+            self.HEADER.unpack_from(self.buf, 0)
+        if magic != self.MAGIC or size != self.size:
+            self.head = 0
+            self.count = 0
+            self._write_header()
 
     def close(self):
-        logger.info('Closing')
+        if self.file is not None:
+            self.buf.flush()
+            self.buf.close()
+            self.file.close()
+            self.file = None
+
+    def append(self, t, value):
         with self.lock:
-            self.closed = True
+            self.SLOT.pack_into(self.buf,
+                                self.HEADER.size + self.SLOT.size * self.head,
+                                t, value)
+            self.head = (self.head + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+            self._write_header()
+
+    def query(self, start, end):
+        with self.lock:
+            first = (self.head - self.count) % self.size
+            samples = [self.SLOT.unpack_from(self.buf,
+                                             self.HEADER.size +
+                                             self.SLOT.size *
+                                             ((first + i) % self.size))
+                       for i in range(self.count)]
+        return [(t, v) for t, v in samples if start <= t < end]
+
+    def _write_header(self):
+        self.HEADER.pack_into(self.buf, 0, self.MAGIC, self.size,
+                              self.head, self.count)
+
+
+# Samples are encoded as the first time and deltas in milliseconds, or as
+# per-step buckets of mean/min/max (null for empty buckets) from the first
+# bucket with samples if step is given
+def encode_history(samples, start, step=None):
+    if step is None:
+        samples = samples[-MAX_HISTORY_POINTS:]
+        times = []
+        last = int(round(samples[0][0] * 1000)) if samples else 0
+        for t, v in samples:
+            ms = int(round(t * 1000))
+            times.append(ms - last)
+            last = ms
+        return {'start': samples[0][0] if samples else None,
+                'times': times, 'values': [v for t, v in samples]}
+    buckets = {}
+    for t, v in samples:
+        buckets.setdefault(int((t - start) / step), []).append(v)
+    if buckets:
+        last = max(buckets.keys())
+        first = max(min(buckets.keys()), last - MAX_HISTORY_POINTS + 1)
+    else:
+        first, last = 0, -1
+    means = []
+    mins = []
+    maxs = []
+    for i in range(first, last + 1):
+        values = buckets.get(i)
+        means.append(float(sum(values)) / len(values) if values else None)
+        mins.append(min(values) if values else None)
+        maxs.append(max(values) if values else None)
+    return {'start': start + first * step, 'step': step, 'mean': means,
+            'min': mins, 'max': maxs}
+
+
+class GrovePiHost(object):
+
+    kind = None
+    deadband = 10
+
+    def __init__(self, name, mqtt_client, interval=CHECK_INTERVAL_SEC,
+                 sensor_id=None, **pipeline_options):
+        self.name = name
+        self.mqtt_client = mqtt_client
+        # Sensors of the same kind are told apart by their ids
+        self.sensor_id = sensor_id if sensor_id is not None else self.kind
+        self.interval = interval
+        history_size = pipeline_options.pop('history_size',
+                                            DEFAULT_HISTORY_SIZE)
+        pipeline_options.setdefault('deadband', self.deadband)
+        self.pipeline = Pipeline(**pipeline_options)
+        path = os.path.join(history_dir, self.sensor_id + '.history') \
+            if history_dir is not None else None
+        self.history = SampleHistory(history_size, path)
 
-    def run(self):
-        host_info = {'status': 'added', 'name': self.name,
-                     'topic': {'light': self._get_topic()}}
-        self.mqtt_client.publish(get_topic(self.name),
-                                 payload=json.dumps(host_info))
+    def _get_topic(self):
+        return get_topic(self.name) + '/' + self.sensor_id
+
+    def _get_host_info(self, status):
+        return {'status': status, 'name': self.name, 'id': self.sensor_id,
+                'topic': {self.kind: self._get_topic(),
+                          'history': self._get_topic() + '/history'}}
 
+    def on_added(self):
+        self.mqtt_client.publish(get_topic(self.name),
+                                 payload=json.dumps(
+                                     self._get_host_info('added')))
         self._prepare()
 
-        while(not self.closed):
+    def on_removed(self):
+        self.mqtt_client.publish(get_topic(self.name),
+                                 payload=json.dumps(
+                                     self._get_host_info('removed')))
+        self.history.close()
+
+    def get_history(self, request):
+        if not isinstance(request, dict):
+            raise ValueError('Invalid request: {}'.format(request))
+        for key in ['start', 'end', 'step']:
+            if key in request and \
+               not isinstance(request[key], (int, long, float)):
+                raise ValueError('Invalid {}: {}'.format(key, request[key]))
+        step = request.get('step')
+        if step is not None and not step > 0:
+            raise ValueError('Invalid step: {}'.format(step))
+        now = time.time()
+        end = request.get('end', now)
+        start = request.get('start', end - 60 * 60)
+        samples = self.history.query(start, end)
+        return encode_history(samples, start, step)
+
+    def sample(self):
+        value = self._read_value()
+        logger.debug('{}: {}'.format(self.sensor_id, value))
+        if value is None:
+            return
+        now = time.time()
+        self.history.append(now, value)
+        aggregate = self.pipeline.put(value, now)
+        if aggregate is None:
+            return
+        msg = self._to_msg(aggregate['mean'])
+        msg.update(aggregate)
+        logger.info('Publish: {}'.format(msg))
+        self.mqtt_client.publish(self._get_topic(), payload=json.dumps(msg))
+
+    def _prepare(self):
+        pass
+
+
+# The only thread which talks to the I2C bus of the GrovePi. Sensors are read
+# one at a time from a timer queue, each at its own interval.
+class BusScheduler(threading.Thread):
+
+    def __init__(self, name, mqtt_client, sensors):
+        super(BusScheduler, self).__init__()
+        self.name = name
+        self.mqtt_client = mqtt_client
+        self.sensors = sensors
+        self.closed = False
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.stats = {'samples': 0, 'missed': 0, 'errors': 0,
+                      'max_lateness': 0.0, 'max_read_time': 0.0}
+        self.daemon = True
+
+    def close(self):
+        logger.info('Closing')
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+
+    def run(self):
+        queue = []
+        now = time.time()
+        for i, sensor in enumerate(self.sensors):
             try:
-                with self.lock:
-                    if not self.closed:
-                        msg = self._read_msg()
-                        if msg is not None:
-                            logger.info('Publish: {}'.format(msg))
-                            topic = self._get_topic()
-                            self.mqtt_client.publish(topic,
-                                                     payload=json.dumps(msg))
+                sensor.on_added()
             except:
                 logger.warning('Unexpected error: %s' % sys.exc_info()[0])
-            time.sleep(CHECK_INTERVAL_SEC)
-
-        host_info['status'] = 'removed'
-        self.mqtt_client.publish(get_topic(self.name),
-                                 payload=json.dumps(host_info))
+            heapq.heappush(queue, (now, i, sensor))
+        last_stats = now
+        while not self._wait_until(queue[0][0] if queue else None):
+            due, i, sensor = heapq.heappop(queue)
+            started = time.time()
+            lateness = started - due
+            try:
+                sensor.sample()
+            except:
+                logger.warning('Unexpected error: %s' % sys.exc_info()[0])
+                self.stats['errors'] += 1
+            finished = time.time()
+            self.stats['samples'] += 1
+            self.stats['max_lateness'] = max(self.stats['max_lateness'],
+                                             lateness)
+            self.stats['max_read_time'] = max(self.stats['max_read_time'],
+                                              finished - started)
+            next_due = due + sensor.interval
+            if next_due < finished:
+                # Deadlines which have already passed are skipped
+                missed = int((finished - next_due) / sensor.interval) + 1
+                self.stats['missed'] += missed
+                next_due += missed * sensor.interval
+            heapq.heappush(queue, (next_due, i, sensor))
+            if last_stats + STATS_INTERVAL_SEC <= finished:
+                self._publish_stats()
+                last_stats = finished
+
+        for sensor in self.sensors:
+            sensor.on_removed()
         logger.info('Closed')
 
+    def _wait_until(self, due):
+        # Returns True if closed
+        with self.cond:
+            while not self.closed:
+                if due is None:
+                    self.cond.wait()
+                    continue
+                wait = due - time.time()
+                if wait <= 0:
+                    break
+                self.cond.wait(wait)
+            return self.closed
+
+    def _publish_stats(self):
+        logger.debug('Stats: {}'.format(self.stats))
+        self.mqtt_client.publish(get_topic(self.name) + '/stats',
+                                 payload=json.dumps(self.stats))
+        self.stats['max_lateness'] = 0.0
+        self.stats['max_read_time'] = 0.0
+
 
 class Sensors(object):
 
-    def __init__(self, sensors):
-        self.sensors = sensors
+    def __init__(self, name, mqtt_client, sensors):
+        self.name = name
+        self.started = False
+        self.scheduler = BusScheduler(name, mqtt_client, sensors)
+        self.histories = dict([(s._get_topic() + '/history', s)
+                               for s in sensors])
 
     def on_connect(self, client, userdata, flags, rc):
-        for s in self.sensors:
-            s.on_connect(client, userdata, flags, rc)
+        logger.info('Connected rc=%d' % rc)
+        client.subscribe(get_topic(self.name) + '/+/history')
+        if not self.started:
+            self.started = True
+            self.scheduler.start()
+
+    def on_message(self, client, userdata, msg):
+        # Requests are like {"start": ..., "end": ..., "step": ...}, and the
+        # response is published to "reply_to" or .../history/result
+        try:
+            logger.info('Received: %s, %s' % (msg.topic, msg.payload))
+            sensor = self.histories.get(msg.topic)
+            if sensor is None:
+                return
+            request = json.loads(msg.payload) if msg.payload else {}
+            response = sensor.get_history(request)
+            if 'id' in request:
+                response['id'] = request['id']
+            client.publish(request.get('reply_to', msg.topic + '/result'),
+                           payload=json.dumps(response,
+                                              separators=(',', ':')))
+        except (ValueError, TypeError, AttributeError, ArithmeticError):
+            logger.error('Unexpected error: %s' % sys.exc_info()[0])
+            errorinfo = {'message': 'Error occurred: %s' % sys.exc_info()[1]}
+            client.publish(msg.topic + '/result',
+                           payload=json.dumps(errorinfo))
 
     def close(self):
-        for s in self.sensors:
-            s.close()
+        self.scheduler.close()
 
 
 class LightSensor(GrovePiHost):
 
-    def __init__(self, name, mqtt_client, light=DEFAULT_LIGHT_SENSOR):
-        super(LightSensor, self).__init__(name, mqtt_client)
-        self.light = light
+    kind = 'light'
 
-    def _get_topic(self):
-        return get_topic(self.name) + '/light'
+    def __init__(self, name, mqtt_client, light=DEFAULT_LIGHT_SENSOR,
+                 **options):
+        super(LightSensor, self).__init__(name, mqtt_client, **options)
+        self.light = light
 
     def _prepare(self):
         return grovepi.pinMode(self.light, "INPUT")
 
-    def _read_msg(self):
+    def _read_value(self):
         # Get sensor value
-        sensor_value = grovepi.analogRead(self.light)
+        return grovepi.analogRead(self.light)
 
+    def _to_msg(self, sensor_value):
         # Calculate resistance of sensor in K
+        if sensor_value <= 0:
+            return {'raw': sensor_value}
         resistance = (float)(1023 - sensor_value) * 10 / sensor_value
-
-        msg = {'raw': sensor_value, 'resistance': resistance}
-        logger.debug('Light: {}'.format(msg))
-        if self.lastValue is not None and \
-            self.lastTime is not None and \
-            self.lastTime + MAX_INTERVAL > time.time() and \
-            abs(self.lastValue - sensor_value) < 10:
-            return None
-        self.lastTime = time.time()
-        self.lastValue = sensor_value
-        return msg
+        return {'raw': sensor_value, 'resistance': resistance}
 
 
 class UltrasonicSensor(GrovePiHost):
 
-    def __init__(self, name, mqtt_client, ultrasonic=DEFAULT_ULTRASONIC_SENSOR):
-        super(UltrasonicSensor, self).__init__(name, mqtt_client)
+    kind = 'ultrasonic'
+
+    def __init__(self, name, mqtt_client, ultrasonic=DEFAULT_ULTRASONIC_SENSOR,
+                 **options):
+        super(UltrasonicSensor, self).__init__(name, mqtt_client, **options)
         self.ultrasonic = ultrasonic
 
-    def _get_topic(self):
-        return get_topic(self.name) + '/ultrasonic'
+    def _read_value(self):
+        # Get sensor value
+        return grovepi.ultrasonicRead(self.ultrasonic)
+
+    def _to_msg(self, distant):
+        return {'distant': distant}
+
+
+class TemperatureSensor(GrovePiHost):
+
+    kind = 'temperature'
+    deadband = 0.5
+
+    def __init__(self, name, mqtt_client, port, module_type=0, **options):
+        super(TemperatureSensor, self).__init__(name, mqtt_client, **options)
+        self.port = port
+        self.module_type = module_type
+        self.humidity = None
+
+    def _read_value(self):
+        temperature, self.humidity = grovepi.dht(self.port, self.module_type)
+        return temperature
+
+    def _to_msg(self, temperature):
+        return {'temperature': temperature, 'humidity': self.humidity}
+
+
+class SoundSensor(GrovePiHost):
+
+    kind = 'sound'
+
+    def __init__(self, name, mqtt_client, port, **options):
+        super(SoundSensor, self).__init__(name, mqtt_client, **options)
+        self.port = port
 
     def _prepare(self):
-        pass
+        return grovepi.pinMode(self.port, "INPUT")
+
+    def _read_value(self):
+        return grovepi.analogRead(self.port)
+
+    def _to_msg(self, level):
+        return {'raw': level}
 
-    def _read_msg(self):
-        # Get sensor value
-        distant = grovepi.ultrasonicRead(self.ultrasonic)
-        msg = {'distant': distant}
-        logger.debug('Ultrasonic: {}'.format(msg))
-        if self.lastValue is not None and \
-            self.lastTime is not None and \
-            self.lastTime + MAX_INTERVAL > time.time() and \
-            abs(self.lastValue - distant) < 10:
-            return None
-        self.lastTime = time.time()
-        self.lastValue = distant
-        return msg
+
+class PIRSensor(GrovePiHost):
+
+    kind = 'motion'
+    deadband = 0.5
+
+    def __init__(self, name, mqtt_client, port, **options):
+        super(PIRSensor, self).__init__(name, mqtt_client, **options)
+        self.port = port
+
+    def _prepare(self):
+        return grovepi.pinMode(self.port, "INPUT")
+
+    def _read_value(self):
+        return grovepi.digitalRead(self.port)
+
+    def _to_msg(self, motion):
+        return {'motion': motion}
+
+
+SENSOR_TYPES = {'light': LightSensor, 'ultrasonic': UltrasonicSensor,
+                'temperature': TemperatureSensor, 'sound': SoundSensor,
+                'pir': PIRSensor}
+
+
+def load_sensors(path, name, mqtt_client):
+    # The config file is a JSON list like
+    # [{"type": "light", "id": "desk", "light": 0, "interval": 1.0,
+    #   "filter": "median", "window": 10.0, "deadband": 5}, ...]; "id"
+    # defaults to the type, and other keys are passed to the constructor of
+    # the sensor
+    with open(path) as f:
+        config = json.load(f)
+    sensors = []
+    for entry in config:
+        params = dict([(str(k), v) for k, v in entry.items()
+                       if k not in ('type', 'id')])
+        if 'id' in entry:
+            params['sensor_id'] = entry['id'].encode('utf8')
+        sensors.append(SENSOR_TYPES[entry['type']](name, mqtt_client,
+                                                   **params))
+    ids = [s.sensor_id for s in sensors]
+    for sensor_id in set(ids):
+        if ids.count(sensor_id) > 1:
+            raise ValueError('Duplicated sensor id: {}'.format(sensor_id))
+    return sensors
 
 
 def main():
@@ -166,20 +552,35 @@ def main():
                         default=DEFAULT_ULTRASONIC_SENSOR,
                         help='Port number of Ultrasonic Sensor(default: {})'
                              .format(DEFAULT_ULTRASONIC_SENSOR))
+    parser.add_argument('-c', '--config', type=str, dest='config',
+                        default=None,
+                        help='JSON file which defines sensors and their '
+                             'intervals(default: light and ultrasonic)')
+    parser.add_argument('--history-dir', type=str, dest='history_dir',
+                        default=None,
+                        help='Directory to keep the history of samples in '
+                             '(default: memory only)')
 
     args = parser.parse_args()
 
-    global topic_base
+    global topic_base, history_dir
     topic_base = args.topic
+    history_dir = args.history_dir
 
     logging.basicConfig(level=get_log_level(args), format=LOG_FORMAT)
 
     mqtt_client = mqtt.Client()
-    light = LightSensor(gethostname(), mqtt_client, light=int(args.light))
-    ultrasonic = UltrasonicSensor(gethostname(), mqtt_client,
-                                  ultrasonic=int(args.ultrasonic))
-    host = Sensors([light, ultrasonic])
+    if args.config is not None:
+        sensors = load_sensors(args.config, gethostname(), mqtt_client)
+    else:
+        light = LightSensor(gethostname(), mqtt_client,
+                            light=int(args.light))
+        ultrasonic = UltrasonicSensor(gethostname(), mqtt_client,
+                                      ultrasonic=int(args.ultrasonic))
+        sensors = [light, ultrasonic]
+    host = Sensors(gethostname(), mqtt_client, sensors)
     mqtt_client.on_connect = host.on_connect
+    mqtt_client.on_message = host.on_message
     connect_mqtt(args, mqtt_client)
     try:
         mqtt_client.loop_forever()
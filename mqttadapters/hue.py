@@ -15,9 +15,43 @@ import paho.mqtt.client as mqtt
 from argparse import ArgumentParser
 import json
 import Queue
+from multiprocessing.pool import ThreadPool
 from common import *
 
 DEFAULT_TOPIC_BASE = 'hue/'
+# Identical commands for at least this many lights are sent as a group action
+GROUP_MIN_LIGHTS = 3
+MAX_TEMPORARY_GROUPS = 8
+TEMPORARY_GROUP_PREFIX = 'mqtt-hue-'
+# Lights are changed one by one for this period after the bridge rejected a
+# new group, e.g. because its group table is full
+GROUP_RETRY_SEC = 300.0
+# Polling interval while the event stream of the bridge is connected
+RECONCILE_INTERVAL_SEC = 60.0
+EVENTSTREAM_RETRY_SEC = 10.0
+# Streams which fail before connecting, e.g. on bridges without HTTPS, are
+# retried with exponential backoff up to this
+EVENTSTREAM_RETRY_MAX_SEC = 600.0
+# A stream which is silent for this long is considered half-open and
+# connected again
+EVENTSTREAM_READ_TIMEOUT_SEC = 120.0
+# A bridge handles about 10 light commands per second
+DEFAULT_COMMAND_RATE = 10.0
+DEFAULT_COMMAND_MAX_AGE_SEC = 5.0
+STATS_INTERVAL_SEC = 60.0
+DESCRIPTION_WORKERS = 8
+DESCRIPTION_TIMEOUT_SEC = 2.0
+# Descriptions which could not be fetched are fetched again after this
+DESCRIPTION_RETRY_SEC = 10.0
+URN_BASIC_DEVICE = 'urn:schemas-upnp-org:device:basic:1'
+# Bridges announce a max-age of 100 sec, so the listener searches for them
+# more often than this
+SEARCH_INTERVAL_SEC = 60.0
+# Cached bridges are removed unless they are found within this period
+CACHE_REVALIDATE_SEC = 120.0
+# Connections to unreachable bridges are retried with exponential backoff
+CONNECT_RETRY_MIN_SEC = 1.0
+CONNECT_RETRY_MAX_SEC = 60.0
 
 topic_base = DEFAULT_TOPIC_BASE
 namespaces = {'upnp': 'urn:schemas-upnp-org:device-1-0'}
@@ -33,10 +67,51 @@ def get_light_topic(udn, light_id):
     return '%s/light/%s' % (get_topic(udn), light_id)
 
 
+def get_group_topic(udn, group_id):
+    return '%s/group/%s' % (get_topic(udn), group_id)
+
+
+def get_stats_topic(udn):
+    return get_topic(udn) + '/stats'
+
+
 def get_error_topic():
     return topic_base + 'error'
 
 
+# MQTT status key -> Hue light state attribute
+STATE_ATTRIBUTES = {'on': 'on', 'saturation': 'sat', 'hue': 'hue',
+                    'brightness': 'bri'}
+
+
+def get_light_status(state):
+    return dict([(key, state.get(attr))
+                 for key, attr in STATE_ATTRIBUTES.items()])
+
+
+def get_state_changes(last_status, next_status):
+    if last_status is None:
+        last_status = {}
+    params = {}
+    for key, attr in STATE_ATTRIBUTES.items():
+        if key in next_status and last_status.get(key) != next_status[key]:
+            params[attr] = next_status[key]
+    if not next_status.get('on', last_status.get('on', True)):
+        # Colour attributes cannot be modified while the light is off
+        params = dict([(k, v) for k, v in params.items() if k == 'on'])
+    return params
+
+
+def get_errors(result):
+    # phue returns the responses of the bridge as they are, and rejected
+    # writes are reported as [{"error": {...}}] instead of an HTTP error
+    if isinstance(result, dict):
+        return [result['error']] if 'error' in result else []
+    if isinstance(result, list):
+        return sum([get_errors(r) for r in result], [])
+    return []
+
+
 class DeviceInfo(object):
 
     def __init__(self, xml):
@@ -56,6 +131,20 @@ class DeviceInfo(object):
         if self.udn is not None:
             self.udn = self.udn.text
 
+    @classmethod
+    def from_cache(cls, entry):
+        dev = cls.__new__(cls)
+        dev.model_name = entry.get('model_name')
+        dev.friendly_name = entry.get('friendly_name')
+        dev.udn = entry['udn']
+        dev.urlbase = entry['urlbase']
+        return dev
+
+    def to_cache(self):
+        return {'model_name': self.model_name,
+                'friendly_name': self.friendly_name,
+                'udn': self.udn, 'urlbase': self.urlbase}
+
     def __repr__(self):
         return '<DeviceInfo({model_name}, {friendly_name}, {urlbase})>' \
                .format(**self.__dict__)
@@ -72,27 +161,51 @@ class DeviceBrowser(threading.Thread):
 
     devices = {}
 
-    def __init__(self, mqtt_client, interval=10.0):
+    def __init__(self, mqtt_client, interval=10.0, cache=None,
+                 interfaces=None, **bridge_options):
         super(DeviceBrowser, self).__init__()
+        self.router = TopicRouter()
         self.mqtt_client = mqtt_client
+        self.cache = cache if cache is not None else DeviceCache(None)
         self.interval = interval
+        self.interfaces = interfaces
+        self.events = Queue.Queue()
+        self.fetching = set()
+        self.bridge_options = bridge_options
         self.lock = threading.Lock()
         self.in_service = True
         self.daemon = True
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=DESCRIPTION_WORKERS)
+        self.session.mount('http://', adapter)
+        self.pool = ThreadPool(DESCRIPTION_WORKERS)
+        # location -> (DeviceInfo, expiration time)
+        self.descriptions = {}
+        # location -> (SSDPResponse, time of the next fetch)
+        self.retries = {}
 
     def on_connect(self, client, userdata, flags, rc):
         logger.info('Connected rc=%d' % rc)
         client.subscribe(topic_base + '+/light/+/status')
+        client.subscribe(topic_base + '+/group/+/status')
 
     def on_message(self, client, userdata, msg):
         logger.info('Received: %s, %s' % (msg.topic, msg.payload))
         try:
-            topic = msg.topic[len(topic_base):].split('/')
             status = json.loads(msg.payload)
-            light_id = topic[2]
-            for dev in self.devices.values():
-                if msg.topic.startswith(dev['topic']):
-                    dev['bridge'].change(light_id, status)
+            if not isinstance(status, dict):
+                raise ValueError('Invalid status: {}'.format(status))
+            dev, topic = self.router.lookup(msg.topic)
+            if dev is None:
+                logger.debug('Unknown device: %s' % msg.topic)
+                return
+            kind = topic[0]
+            target_id = topic[1]
+            if kind == 'group':
+                dev['bridge'].change_group(target_id, status)
+            else:
+                dev['bridge'].change(target_id, status)
         except (ValueError):
             logger.error('Unexpected error: %s' % sys.exc_info()[0])
             errorinfo = {'message': 'Error occurred: %s' % sys.exc_info()[0]}
@@ -102,42 +215,118 @@ class DeviceBrowser(threading.Thread):
         with self.lock:
             self.in_service = False
 
+    def on_ssdp(self, event, response):
+        self.events.put((event, response, None))
+
     def run(self):
+        # Bridges found by the previous process are used right away, and
+        # revalidated by the discovery below
+        for udn, entry in self.cache.items():
+            logger.info('Cached: %s' % udn)
+            self._add_device(DeviceInfo.from_cache(entry),
+                             entry.get('lights', {}), confirmed=False)
+        listener = ssdp.SSDPListener(URN_BASIC_DEVICE, self.on_ssdp,
+                                     interfaces=self.interfaces,
+                                     search_interval=SEARCH_INTERVAL_SEC)
+        listener.start()
         while(self._in_service()):
-            devices = self._discover_hue()
-            logger.debug('Found: %s' % str(devices))
-            added = []
-            removed = []
-            for dev in devices:
-                if dev.udn not in self.devices:
-                    added.append(dev)
+            try:
+                event, response, dev = self.events.get(True, self.interval)
+            except Queue.Empty:
+                self._expire()
+                self._retry()
+                continue
+            logger.debug('SSDP %s: %s' % (event, response))
+            if event == 'alive':
+                self._on_alive(response)
+            elif event == 'described':
+                self.fetching.discard(response.location)
+                if dev is not None:
+                    self.retries.pop(response.location, None)
+                    self.descriptions[response.location] = \
+                        (dev, time.time() + response.get_max_age())
+                    self._on_found(dev)
                 else:
-                    self.devices[dev.udn]['remove'] = 0
-            for dev in self.devices.values():
-                found = filter(lambda x: x.udn == dev['device'].udn, devices)
-                if not found:
-                    dev['remove'] += 1
-                    logger.debug('Not found: %s (count=%d)'
-                                 % (dev['device'].udn, dev['remove']))
-                    if dev['remove'] > 5:
-                        removed.append(dev['device'])
-            for d in added:
-                self.on_added(d)
-                b = HueBridge(self.mqtt_client, d)
-                self.devices[d.udn] = {'remove': 0, 'device': d, 'bridge': b,
-                                       'topic': get_topic(d.udn)}
-                b.start()
-            for d in removed:
-                self.on_removed(d)
-                self.devices[d.udn]['bridge'].inactivate()
-                del self.devices[d.udn]
-            time.sleep(self.interval)
+                    # The listener does not announce the location again
+                    # while the device keeps sending NOTIFY
+                    self.retries[response.location] = \
+                        (response, time.time() + DESCRIPTION_RETRY_SEC)
+            else:
+                self.retries.pop(response.location, None)
+                udn = response.usn.split('::')[0]
+                if udn in self.devices:
+                    self._remove_device(self.devices[udn]['device'])
+            self._retry()
+        listener.inactivate()
+
+    def _retry(self):
+        now = time.time()
+        for location, (response, retry_at) in self.retries.items():
+            if retry_at <= now:
+                del self.retries[location]
+                self._on_alive(response)
+
+    def _on_alive(self, response):
+        description = self.descriptions.get(response.location)
+        if description is not None and description[1] > time.time():
+            self._on_found(description[0])
+            return
+        if response.location in self.fetching:
+            return
+        self.fetching.add(response.location)
+        callback = lambda dev: self.events.put(('described', response, dev))
+        self.pool.apply_async(self._fetch_description, (response,),
+                              callback=callback)
+
+    def _on_found(self, dev):
+        if not dev.model_name or \
+           not dev.model_name.startswith('Philips hue bridge'):
+            return
+        if dev.udn in self.devices:
+            if self.devices[dev.udn]['device'].urlbase == dev.urlbase:
+                self.devices[dev.udn]['confirmed'] = True
+                return
+            logger.info('Moved: %s' % dev.udn)
+            self._remove_device(self.devices[dev.udn]['device'])
+        entry = dev.to_cache()
+        entry['lights'] = {}
+        self.cache.put(dev.udn, entry)
+        self._add_device(dev, {})
+
+    def _expire(self):
+        now = time.time()
+        for location, (dev, expires) in self.descriptions.items():
+            if expires <= now:
+                del self.descriptions[location]
+        for dev in self.devices.values():
+            if not dev['confirmed'] and \
+               dev['added'] + CACHE_REVALIDATE_SEC <= now:
+                logger.debug('Not found: %s' % dev['device'].udn)
+                self._remove_device(dev['device'])
+
+    def _add_device(self, d, cached_lights, confirmed=True):
+        self.on_added(d)
+        b = HueBridge(self.mqtt_client, d, cache=self.cache,
+                      cached_lights=cached_lights, **self.bridge_options)
+        self.devices[d.udn] = {'confirmed': confirmed, 'added': time.time(),
+                               'device': d, 'bridge': b,
+                               'topic': get_topic(d.udn)}
+        self.router.add(get_topic(d.udn), self.devices[d.udn])
+        b.start()
+
+    def _remove_device(self, d):
+        self.on_removed(d)
+        self.devices[d.udn]['bridge'].inactivate()
+        self.router.remove(self.devices[d.udn]['topic'])
+        del self.devices[d.udn]
+        self.cache.remove(d.udn)
 
     def on_added(self, device):
         logger.info('Added: %s' % device.urlbase)
         host_info = {'status': 'added', 'urlbase': device.urlbase,
                      'udn': device.udn,
-                     'topic': {'light': get_topic(device.udn) + '/light'}}
+                     'topic': {'light': get_topic(device.udn) + '/light',
+                               'stats': get_stats_topic(device.udn)}}
         self.mqtt_client.publish(get_topic(device.udn),
                                  payload=json.dumps(host_info))
 
@@ -145,7 +334,8 @@ class DeviceBrowser(threading.Thread):
         logger.info('Removed: %s' % device.urlbase)
         host_info = {'status': 'removed', 'urlbase': device.urlbase,
                      'udn': device.udn,
-                     'topic': {'light': get_topic(device.udn) + '/light'}}
+                     'topic': {'light': get_topic(device.udn) + '/light',
+                               'stats': get_stats_topic(device.udn)}}
         self.mqtt_client.publish(get_topic(device.udn),
                                  payload=json.dumps(host_info))
 
@@ -153,126 +343,470 @@ class DeviceBrowser(threading.Thread):
         with self.lock:
             return self.in_service
 
-    def _discover_hue(self):
-        responses = ssdp.discover('ssdp:discover')
-        urn_device = 'urn:schemas-upnp-org:device:basic:1'
-        targets = filter(lambda x: x.st == urn_device,
-                         responses)
-        devices = []
-        for target in targets:
-            resp = requests.get(target.location)
-            dev = DeviceInfo(resp.content)
-            if dev.model_name.startswith('Philips hue bridge'):
-                devices.append(dev)
-        return devices
+    def _fetch_description(self, target):
+        try:
+            resp = self.session.get(target.location,
+                                    timeout=DESCRIPTION_TIMEOUT_SEC)
+            resp.raise_for_status()
+            return DeviceInfo(resp.content)
+        except:
+            logger.debug('Failed to fetch %s: %s' %
+                         (target.location, sys.exc_info()[1]))
+            return None
+
+
+class PendingCommands(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.woken = False
+
+    def put(self, key, status):
+        with self.cond:
+            if key in self.pending:
+                self.pending[key]['status'].update(status)
+                self.pending[key]['time'] = time.time()
+            else:
+                self.pending[key] = {'status': dict(status),
+                                     'time': time.time()}
+            self.cond.notify()
+
+    def depth(self):
+        with self.cond:
+            return len(self.pending)
+
+    def wake(self):
+        with self.cond:
+            self.woken = True
+            self.cond.notify()
+
+    def take_all(self, timeout, window=0.0):
+        with self.cond:
+            if not self.pending and not self.woken:
+                self.cond.wait(timeout)
+            self.woken = False
+            if self.pending and window > 0:
+                # Collect the rest of a burst so that it can be fanned out
+                deadline = time.time() + window
+                remaining = window
+                while remaining > 0:
+                    self.cond.wait(remaining)
+                    remaining = deadline - time.time()
+            pending = self.pending
+            self.pending = {}
+            return pending
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def get_wait(self):
+        self._refill()
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def consume(self):
+        wait = self.get_wait()
+        if wait > 0:
+            time.sleep(wait)
+            self._refill()
+        self.tokens -= 1.0
+
+    def penalize(self):
+        # The bridge rejected a command, wait for a second before the next
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - self.rate
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+# Consumes the server-sent events of /eventstream/clip/v2 and calls
+# on_changed with the (v1) ids of the updated lights
+class EventStream(threading.Thread):
+
+    def __init__(self, ip, username, on_changed):
+        super(EventStream, self).__init__()
+        self.url = 'https://%s/eventstream/clip/v2' % ip
+        self.username = username
+        self.on_changed = on_changed
+        self.lock = threading.Lock()
+        self.in_service = True
+        self.connected = False
+        self.available = True
+        self.daemon = True
+
+    def inactivate(self):
+        with self.lock:
+            self.in_service = False
+
+    def is_connected(self):
+        with self.lock:
+            return self.connected
+
+    def run(self):
+        wait = EVENTSTREAM_RETRY_SEC
+        failures = 0
+        while(self._in_service() and self.available):
+            try:
+                self._consume()
+            except:
+                # Only the first of consecutive failures is a warning
+                log = logger.warning if failures == 0 else logger.debug
+                log('Event stream error: %s' % sys.exc_info()[1])
+            if self.is_connected():
+                failures = 0
+                wait = EVENTSTREAM_RETRY_SEC
+            else:
+                failures += 1
+            self._set_connected(False)
+            if self._in_service() and self.available:
+                time.sleep(wait)
+                if failures > 0:
+                    wait = min(wait * 2, EVENTSTREAM_RETRY_MAX_SEC)
+        logger.info('Event stream finished: %s' % self.url)
+
+    def _consume(self):
+        headers = {'hue-application-key': self.username,
+                   'Accept': 'text/event-stream'}
+        # The bridge uses a self-signed certificate
+        resp = requests.get(self.url, headers=headers, stream=True,
+                            verify=False,
+                            timeout=(5.0, EVENTSTREAM_READ_TIMEOUT_SEC))
+        if resp.status_code == 404:
+            logger.info('Event stream is not supported: %s' % self.url)
+            self.available = False
+            return
+        resp.raise_for_status()
+        logger.info('Event stream connected: %s' % self.url)
+        self._set_connected(True)
+        data = []
+        for line in resp.iter_lines():
+            if not self._in_service():
+                break
+            if line.startswith('data:'):
+                data.append(line[5:].strip())
+            elif not line and data:
+                self._on_event('\n'.join(data))
+                data = []
+        resp.close()
+
+    def _on_event(self, data):
+        light_ids = set()
+        for event in json.loads(data):
+            if event.get('type') != 'update':
+                continue
+            for resource in event.get('data', []):
+                id_v1 = resource.get('id_v1', '')
+                if id_v1.startswith('/lights/'):
+                    light_ids.add(id_v1[len('/lights/'):])
+        if light_ids:
+            logger.debug('Event: %s' % sorted(light_ids))
+            self.on_changed(light_ids)
+
+    def _set_connected(self, connected):
+        with self.lock:
+            self.connected = connected
+
+    def _in_service(self):
+        with self.lock:
+            return self.in_service
 
 
 class HueBridge(threading.Thread):
 
-    def __init__(self, mqtt_client, device, interval=1.0):
+    def __init__(self, mqtt_client, device, interval=1.0, window=0.05,
+                 use_eventstream=True, rate=DEFAULT_COMMAND_RATE,
+                 max_age=DEFAULT_COMMAND_MAX_AGE_SEC, cache=None,
+                 cached_lights={}):
         super(HueBridge, self).__init__()
         self.mqtt_client = mqtt_client
         self.device = device
+        self.cache = cache if cache is not None else DeviceCache(None)
+        self.cached_lights = cached_lights
         self.interval = interval
-        self.actions = Queue.Queue()
+        self.window = window
+        self.use_eventstream = use_eventstream
+        self.max_age = max_age
+        self.bucket = TokenBucket(rate)
+        self.stats = {'sent': 0, 'dropped': 0, 'errors': 0,
+                      'wait_total': 0.0, 'wait_max': 0.0}
+        self.actions = PendingCommands()
+        self.temporary_groups = []
+        self.group_retry_at = 0
         self.lock = threading.Lock()
         self.in_service = True
+        self.changed = False
 
     def inactivate(self):
         with self.lock:
             self.in_service = False
 
+    def on_changed(self, light_ids):
+        with self.lock:
+            self.changed = True
+        self.actions.wake()
+
     def change(self, light_id, status):
         logger.info('Reserved: %s, %s' % (self.device.udn, light_id))
-        self.actions.put({'id': light_id, 'status': status})
+        self.actions.put(('light', light_id), status)
+
+    def change_group(self, group_id, status):
+        logger.info('Reserved: %s, group %s' % (self.device.udn, group_id))
+        self.actions.put(('group', group_id), status)
 
     def run(self):
-        b = Bridge(self.device.get_ip())
-        b.connect()
-        logger.info('Bridge state: %s' % str(b.get_api()))
+        b = self._connect()
+        if b is None:
+            return
+        stream = None
+        if self.use_eventstream:
+            stream = EventStream(self.device.get_ip(), b.username,
+                                 self.on_changed)
+            stream.start()
         lights = {}
-        next_action = None
+        for lid, name in self.cached_lights.items():
+            lights[lid] = {'name': name, 'last_status': None}
+            self._publish_light(lid, 'added', name)
+        next_actions = {}
+        last_polled = None
+        last_stats = time.time()
         while(self._in_service()):
-            if next_action:
-                logger.info('Changing... %s' % str(next_action))
-                light_id = next_action['id']
-                next_status = next_action['status']
-                if light_id in lights \
-                   and lights[light_id]['last_status'] != next_status:
-                    logger.info('Change: %s, %s' % (light_id, next_status))
-                    if lights[light_id]['last_status'] is None:
-                        lights[light_id]['last_status'] = {}
-                    last_status = lights[light_id]['last_status']
-                    light = lights[light_id]['device']
-                    if next_status['on']:
-                        last_status['on'] = next_status['on']
-                        light.on = next_status['on']
-                    if 'hue' in next_status:
-                        last_status['hue'] = next_status['hue']
-                        light.hue = next_status['hue']
-                    if 'saturation' in next_status:
-                        last_status['saturation'] = next_status['saturation']
-                        light.saturation = next_status['saturation']
-                    if 'brightness' in next_status:
-                        last_status['brightness'] = next_status['brightness']
-                        light.brightness = next_status['brightness']
-                    if 'on' in next_status and \
-                       last_status['on'] != next_status['on']:
-                        last_status['on'] = next_status['on']
-                        light.on = next_status['on']
-                else:
-                    logger.info('Ignored: %s, %s' % (light_id, next_status))
-            logger.debug('Retrieving status of lights...')
-            current = {}
-            added = []
-            removed = []
             try:
-                for l in b.lights:
-                    current[b.get_light_id_by_name(l.name)] = l
-                for lid, light in current.items():
-                    if lid not in lights:
-                        added.append(lid)
-                for lid, light in lights.items():
-                    if lid not in current:
-                        removed.append(lid)
-                for lid in added:
-                    lights[lid] = {'device': current[lid], 'last_status': None}
-                    msg = {'id': lid, 'action': 'added',
-                           'name': current[lid].name,
-                           'topic': {'light': get_light_topic(self.device.udn,
-                                                              lid)}}
-                    self.mqtt_client.publish(get_light_topic(self.device.udn,
-                                                             lid),
-                                             payload=json.dumps(msg))
-                for lid in removed:
-                    old = lights[lid]['device']
-                    del lights[lid]
-                    msg = {'id': lid, 'action': 'removed', 'name': old.name,
-                           'topic': {'light': get_light_topic(self.device.udn,
-                                                              lid)}}
-                    self.mqtt_client.publish(get_light_topic(self.device.udn,
-                                                             lid),
-                                             payload=json.dumps(msg))
-                for lid, light_entry in lights.items():
-                    light = light_entry['device']
-                    status = {'on': light.on, 'saturation': light.saturation,
-                              'hue': light.hue, 'brightness': light.brightness}
-                    if status != light_entry['last_status']:
-                        logger.debug('%s: status=%s' %
-                                     (light.name, str(status)))
-                        light_entry['last_status'] = status
-                        topic = '%s/status' % get_light_topic(self.device.udn,
-                                                              lid)
-                        self.mqtt_client.publish(topic,
-                                                 payload=json.dumps(status))
+                self._apply_actions(b, lights, next_actions)
             except:
                 logger.warning('Unexpected error: %s' % sys.exc_info()[0])
-
-            logger.debug('Retrieving finished')
+            streaming = stream is not None and stream.is_connected()
+            # While the event stream is connected, changes are pushed by the
+            # bridge and only a slow reconciliation poll is needed.
+            interval = RECONCILE_INTERVAL_SEC if streaming else self.interval
+            if self._take_changed() or last_polled is None or \
+               last_polled + interval <= time.time():
+                logger.debug('Retrieving status of lights...')
+                try:
+                    self._poll_lights(b, lights)
+                except:
+                    logger.warning('Unexpected error: %s' %
+                                   sys.exc_info()[0])
+                last_polled = time.time()
+                logger.debug('Retrieving finished')
+            if last_stats + STATS_INTERVAL_SEC <= time.time():
+                self._publish_stats()
+                last_stats = time.time()
+            wait = max(last_polled + interval - time.time(), 0.0)
+            next_actions = self.actions.take_all(wait, self.window)
+        if stream is not None:
+            stream.inactivate()
+
+    def _connect(self):
+        # Cached bridges are started before they are found, and may not be
+        # reachable yet
+        wait = CONNECT_RETRY_MIN_SEC
+        while self._in_service():
             try:
-                next_action = self.actions.get(True, self.interval)
-            except Queue.Empty:
-                next_action = None
+                b = Bridge(self.device.get_ip())
+                b.connect()
+                logger.info('Bridge state: %s' % str(b.get_api()))
+                return b
+            except:
+                logger.warning('Failed to connect %s: %s' %
+                               (self.device.get_ip(), sys.exc_info()[1]))
+            time.sleep(wait)
+            wait = min(wait * 2, CONNECT_RETRY_MAX_SEC)
+        return None
+
+    def _apply_actions(self, b, lights, next_actions):
+        commands = []
+        changes = {}
+        for (kind, target_id), entry in next_actions.items():
+            next_status = entry['status']
+            if kind == 'group':
+                params = get_state_changes(None, next_status)
+                commands.append({'group': target_id, 'lights': [],
+                                 'params': params, 'time': entry['time']})
+                continue
+            logger.info('Changing... %s, %s' % (target_id, next_status))
+            if target_id not in lights:
+                logger.info('Ignored: %s, %s' % (target_id, next_status))
+                continue
+            params = get_state_changes(lights[target_id]['last_status'],
+                                       next_status)
+            if not params:
+                logger.info('Ignored: %s, %s' % (target_id, next_status))
+                continue
+            key = tuple(sorted(params.items()))
+            changes.setdefault(key, []).append((target_id, entry['time']))
+        for key, targets in changes.items():
+            params = dict(key)
+            light_ids = [light_id for light_id, t in targets]
+            reserved = max([t for light_id, t in targets])
+            if len(light_ids) >= GROUP_MIN_LIGHTS:
+                commands.append({'group': None, 'lights': light_ids,
+                                 'params': params, 'time': reserved})
+            else:
+                for light_id, t in targets:
+                    commands.append({'group': None, 'lights': [light_id],
+                                     'params': params, 'time': t})
+        # Explicit on/off commands are sent before gradual changes
+        commands.sort(key=lambda c: ('on' not in c['params'], c['time']))
+        for command in commands:
+            waited = time.time() - command['time']
+            if waited + self.bucket.get_wait() > self.max_age:
+                logger.info('Dropped: %s, %s' % (command['group'] or
+                                                 command['lights'],
+                                                 command['params']))
+                self.stats['dropped'] += 1
+                continue
+            self.bucket.consume()
+            waited = time.time() - command['time']
+            try:
+                self._send_command(b, command)
+            except:
+                logger.warning('Command failed: %s' % sys.exc_info()[1])
+                self.stats['errors'] += 1
+                self.bucket.penalize()
+                continue
+            self.stats['sent'] += 1
+            self.stats['wait_total'] += waited
+            self.stats['wait_max'] = max(self.stats['wait_max'], waited)
+            for light_id in command['lights']:
+                self._update_last_status(lights[light_id], command['params'])
+
+    def _send_command(self, b, command):
+        params = command['params']
+        light_ids = command['lights']
+        if command['group'] is not None:
+            logger.info('Change: group %s, %s' % (command['group'], params))
+            result = b.set_group(int(command['group']), params)
+        elif len(light_ids) >= GROUP_MIN_LIGHTS:
+            group_id = self._get_group_for(b, light_ids)
+            if group_id is not None:
+                logger.info('Change: group %s (%s), %s' %
+                            (group_id, light_ids, params))
+                result = b.set_group(int(group_id), params)
+            else:
+                result = []
+                for i, light_id in enumerate(sorted(light_ids, key=int)):
+                    logger.info('Change: %s, %s' % (light_id, params))
+                    if i > 0:
+                        self.bucket.consume()
+                    result.append(b.set_light(int(light_id), params))
+        else:
+            logger.info('Change: %s, %s' % (light_ids[0], params))
+            # All changed attributes are sent as one PUT /lights/<id>/state
+            result = b.set_light(int(light_ids[0]), params)
+        errors = get_errors(result)
+        if errors:
+            raise IOError('Rejected by the bridge: %s' % errors)
+
+    def _publish_stats(self):
+        stats = {'queue_depth': self.actions.depth(),
+                 'sent': self.stats['sent'],
+                 'dropped': self.stats['dropped'],
+                 'errors': self.stats['errors'],
+                 'wait_max': self.stats['wait_max']}
+        if self.stats['sent'] > 0:
+            stats['wait_avg'] = self.stats['wait_total'] / self.stats['sent']
+        logger.debug('Stats: %s' % str(stats))
+        self.stats['wait_max'] = 0.0
+        self.mqtt_client.publish(get_stats_topic(self.device.udn),
+                                 payload=json.dumps(stats))
+
+    def _update_last_status(self, light_entry, params):
+        if light_entry['last_status'] is None:
+            light_entry['last_status'] = {}
+        for key, attr in STATE_ATTRIBUTES.items():
+            if attr in params:
+                light_entry['last_status'][key] = params[attr]
+
+    def _get_group_for(self, b, light_ids):
+        members = set(light_ids)
+        groups = b.get_group()
+        self.temporary_groups = [gid for gid in self.temporary_groups
+                                 if gid in groups]
+        for group_id, group in groups.items():
+            if group['name'].startswith(TEMPORARY_GROUP_PREFIX) and \
+               group_id not in self.temporary_groups:
+                # Left by a previous process
+                self.temporary_groups.append(group_id)
+        for group_id, group in groups.items():
+            if set(group['lights']) == members:
+                return group_id
+        if self.group_retry_at > time.time():
+            return None
+        if len(self.temporary_groups) >= MAX_TEMPORARY_GROUPS:
+            old_id = self.temporary_groups.pop(0)
+            logger.info('Deleting temporary group: %s' % old_id)
+            self.bucket.consume()
+            b.delete_group(int(old_id))
+        name = '%s%d' % (TEMPORARY_GROUP_PREFIX, int(time.time() * 1000))
+        self.bucket.consume()
+        resp = b.create_group(name, sorted(light_ids, key=int))
+        errors = get_errors(resp)
+        if errors or not resp:
+            logger.warning('Failed to create a group: %s' % errors)
+            self.group_retry_at = time.time() + GROUP_RETRY_SEC
+            return None
+        group_id = resp[0]['success']['id']
+        logger.info('Created temporary group: %s %s' % (group_id, light_ids))
+        self.temporary_groups.append(group_id)
+        return group_id
+
+    def _poll_lights(self, b, lights):
+        # A single GET /api/<user>/lights returns the state of every light,
+        # so the cost of a cycle does not depend on the number of lights.
+        current = b.get_light()
+        added = []
+        removed = []
+        for lid in current.keys():
+            if lid not in lights:
+                added.append(lid)
+        for lid in lights.keys():
+            if lid not in current:
+                removed.append(lid)
+        for lid in added:
+            lights[lid] = {'name': current[lid]['name'], 'last_status': None}
+            self._publish_light(lid, 'added', current[lid]['name'])
+        for lid in removed:
+            old = lights[lid]
+            del lights[lid]
+            self._publish_light(lid, 'removed', old['name'])
+        for lid, light_entry in lights.items():
+            light_entry['name'] = current[lid]['name']
+            status = get_light_status(current[lid]['state'])
+            if status != light_entry['last_status']:
+                logger.debug('%s: status=%s' %
+                             (light_entry['name'], str(status)))
+                light_entry['last_status'] = status
+                topic = '%s/status' % get_light_topic(self.device.udn, lid)
+                self.mqtt_client.publish(topic, payload=json.dumps(status))
+        entry = self.cache.get(self.device.udn)
+        if entry is not None:
+            entry['lights'] = dict([(lid, light_entry['name'])
+                                    for lid, light_entry in lights.items()])
+            self.cache.put(self.device.udn, entry)
+
+    def _publish_light(self, lid, action, name):
+        msg = {'id': lid, 'action': action, 'name': name,
+               'topic': {'light': get_light_topic(self.device.udn, lid)}}
+        self.mqtt_client.publish(get_light_topic(self.device.udn, lid),
+                                 payload=json.dumps(msg))
+
+    def _take_changed(self):
+        with self.lock:
+            changed = self.changed
+            self.changed = False
+            return changed
 
     def _in_service(self):
         with self.lock:
@@ -283,6 +817,23 @@ def main():
     desc = '%s [Args] [Options]\nDetailed options -h or --help' % __file__
     parser = ArgumentParser(description=desc)
     add_mqtt_arguments(parser, topic_default=DEFAULT_TOPIC_BASE)
+    add_cache_arguments(parser, 'hue')
+    parser.add_argument('-i', '--interface', type=str, dest='interfaces',
+                        action='append', default=None,
+                        help='address of the interface to discover bridges'
+                             '(default: all)')
+    parser.add_argument('--no-eventstream', dest='eventstream',
+                        action='store_false',
+                        help='poll lights without the event stream of bridges')
+    parser.add_argument('--rate', type=float, dest='rate',
+                        default=DEFAULT_COMMAND_RATE,
+                        help='max commands per second for a bridge'
+                             '(default: {})'.format(DEFAULT_COMMAND_RATE))
+    parser.add_argument('--max-age', type=float, dest='max_age',
+                        default=DEFAULT_COMMAND_MAX_AGE_SEC,
+                        help='seconds after which pending commands are '
+                             'dropped(default: {})'
+                             .format(DEFAULT_COMMAND_MAX_AGE_SEC))
 
     args = parser.parse_args()
 
@@ -292,7 +843,10 @@ def main():
     logging.basicConfig(level=get_log_level(args), format=LOG_FORMAT)
 
     mqtt_client = mqtt.Client()
-    browser = DeviceBrowser(mqtt_client)
+    browser = DeviceBrowser(mqtt_client, cache=DeviceCache(args.cache),
+                            interfaces=args.interfaces,
+                            use_eventstream=args.eventstream,
+                            rate=args.rate, max_age=args.max_age)
     mqtt_client.on_connect = browser.on_connect
     mqtt_client.on_message = browser.on_message
     connect_mqtt(args, mqtt_client)
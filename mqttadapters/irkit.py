@@ -5,13 +5,20 @@ from zeroconf import ServiceBrowser, Zeroconf
 import threading
 import time
 import ipaddress
+import os
 import subprocess
 import sys
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import paho.mqtt.client as mqtt
 import logging
 import logging.config
 import json
+import base64
+import heapq
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from argparse import ArgumentParser
 from common import *
 
@@ -19,205 +26,613 @@ SERVICE_TYPE = '_irkit._tcp.local.'
 DEFAULT_TOPIC_BASE = 'irkit/'
 CHECK_INTERVAL_SEC = 5.0
 SERVICE_TIMEOUT = 60
+ECHO_TTL_SEC = 10.0
+ECHO_CACHE_SIZE = 64
+DECODED_CACHE_SIZE = 256
+# Receive polling is fast for a window after any activity, and then backs
+# off exponentially up to the ceiling
+DEFAULT_POLL_FLOOR_SEC = 0.2
+DEFAULT_POLL_CEILING_SEC = 10.0
+BURST_WINDOW_SEC = 10.0
+LEARN_WINDOW_SEC = 60.0
+# Threads which run the HTTP requests of polls for all hosts
+POLL_WORKERS = 8
+CONNECT_TIMEOUT_SEC = 2.0
+SEND_TIMEOUT_SEC = 5.0
+# Polls are time-boxed so that a send never waits long behind them
+RECEIVE_TIMEOUT_SEC = 1.0
+# Resolutions of services dropped by the dispatcher are submitted again
+RESOLVE_RETRY_SEC = 5.0
+STATS_INTERVAL_SEC = 60.0
 
 topic_base = DEFAULT_TOPIC_BASE
 logger = logging.getLogger()
 
 
+def get_host_name(name):
+    # IRKitD2A4._irkit._tcp.local. -> IRKitD2A4
+    return name[:name.index('.')] if '.' in name else name
+
+
 def get_topic(name):
-    if '.' in name:
-        return topic_base + name[:name.index('.')].encode('utf8')
-    else:
-        return topic_base + name.encode('utf8')
+    return topic_base + get_host_name(name).encode('utf8')
 
 
 def get_messages_topic(name):
     return get_topic(name) + '/messages'
 
 
+def get_learn_topic(name):
+    return get_topic(name) + '/learn'
+
+
 def get_error_topic():
     return topic_base + 'error'
 
 
+def get_stats_topic():
+    return topic_base + 'stats'
+
+
 class HostListener(object):
 
     hosts = {}
-    removed = []
 
-    def __init__(self, mqtt_client):
+    def __init__(self, mqtt_client, cache=None, library=None,
+                 dispatcher=None, poll_settings=None, **host_options):
         self.mqtt_client = mqtt_client
-        self.finished_lock = threading.Lock()
+        self.dispatcher = dispatcher if dispatcher is not None \
+            else Dispatcher(on_error=self.on_error, on_drop=self.on_drop)
+        self.library = library if library is not None else SignalLibrary(None)
+        self.host_options = host_options
+        # IRKit name -> {"poll_floor", "poll_ceiling"}
+        self.poll_settings = poll_settings or {}
+        self.lock = threading.RLock()
+        self.router = TopicRouter()
+        self.poller = PollScheduler()
+        self.poller.start()
+        self.cache = cache if cache is not None else DeviceCache(None)
+
+    def load_cache(self):
+        # Hosts found by the previous process are used right away; they are
+        # removed after the service timeout unless zeroconf announces them
+        for name, entry in self.cache.items():
+            logger.info('Cached: %s (%s:%d)' %
+                        (name, entry['address'], entry['port']))
+            host = self._add_host(name, entry['address'], entry['port'])
+            host.inactivate()
 
     def remove_service(self, zeroconf, type, name):
         logger.info('Service %s removed' % (name,))
-        self._refresh_hosts()
-        if name in self.hosts:
-            self.hosts[name].inactivate()
+        with self.lock:
+            if name in self.hosts:
+                self.hosts[name].inactivate()
 
     def add_service(self, zeroconf, type, name):
+        logger.info('Service %s added' % (name,))
+        entry = self.cache.get(name)
+        with self.lock:
+            if name in self.hosts:
+                self.hosts[name].activate()
+            elif entry is not None:
+                self._add_host(name, entry['address'], entry['port'])
+        # get_service_info blocks the thread of zeroconf, so the address is
+        # resolved by the dispatcher; cached hosts are used meanwhile
+        self.dispatcher.submit(name, self._resolve_service, zeroconf, type,
+                               name)
+
+    def _resolve_service(self, zeroconf, type, name):
         info = zeroconf.get_service_info(type, name)
-        logger.info('Service %s added, service info: %s' % (name, info))
-        self._refresh_hosts()
-        if info:
+        logger.info('Service %s resolved, service info: %s' % (name, info))
+        if not info:
+            return
+        with self.lock:
             if name not in self.hosts:
-                host = IRKitHost(name, info.address, info.port,
-                                 self.mqtt_client)
-                host.on_finished = self.on_finished
-                self.hosts[name] = host
-                host.start()
-                logger.info('Subscribe: %s' % get_messages_topic(name))
+                host = self._add_host(name, info.address, info.port)
             else:
-                self.hosts[name].activate()
+                host = self.hosts[name]
+                host.set_address(info.address, info.port)
+                host.activate()
+        self.cache.put(name, {'address': host.address, 'port': host.port})
+
+    def _add_host(self, name, address, port):
+        options = dict(self.host_options)
+        options.update(self.poll_settings.get(get_host_name(name), {}))
+        host = IRKitHost(name, address, port, self.mqtt_client,
+                         self.library, self.poller, **options)
+        host.on_finished = self.on_finished
+        with self.lock:
+            self.hosts[name] = host
+        self.router.add(get_messages_topic(name), host)
+        self.router.add(get_learn_topic(name), host)
+        host.start()
+        logger.info('Subscribe: %s' % get_messages_topic(name))
+        return host
 
     def on_connect(self, client, userdata, flags, rc):
         logger.info('Connected rc=%d' % rc)
         client.subscribe(topic_base + '+/messages')
+        client.subscribe(topic_base + '+/learn')
 
     def on_message(self, client, userdata, msg):
         try:
             logger.info('Received: %s, %s' % (msg.topic, msg.payload))
+            if msg.topic.endswith('/learn'):
+                host = self.router.get(msg.topic)
+                if host is not None:
+                    # The next signal is stored as {"name": ...} if given
+                    params = json.loads(msg.payload) if msg.payload else {}
+                    if not isinstance(params, dict):
+                        raise ValueError('Invalid request: {}'.format(params))
+                    host.learn(params.get('name'))
+                return
             command = json.loads(msg.payload)
+            if not isinstance(command, dict):
+                raise ValueError('Invalid messages: {}'.format(command))
             assert(msg.topic.startswith(topic_base))
             topic_sub = msg.topic[len(topic_base):]
             assert(topic_sub.endswith('/messages'))
             to = topic_sub[:-len('/messages')]
+            # Sends are run by the dispatcher so that HTTP requests do not
+            # block the network thread of paho
             if to == 'all':
-                for host in self.hosts.values():
-                    host.post(command)
+                with self.lock:
+                    hosts = self.hosts.values()
+                for host in hosts:
+                    self.dispatcher.submit(host.name, host.post, command)
             else:
-                for name, host in self.hosts.items():
-                    if get_messages_topic(name) == msg.topic:
-                        host.post(command)
-        except (ValueError, IOError):
+                host = self.router.get(msg.topic)
+                if host is not None:
+                    self.dispatcher.submit(host.name, host.post, command)
+        except (ValueError, IOError, TypeError, AttributeError):
             logger.error('Unexpected error: %s' % sys.exc_info()[0])
             errorinfo = {'message': 'Error occurred: %s' % sys.exc_info()[0]}
             client.publish(get_error_topic(), payload=json.dumps(errorinfo))
 
-    def on_finished(self, name):
-        logger.debug('Finished: %s' % name)
-        with self.finished_lock:
-            self.removed.append(name)
-
-    def _refresh_hosts(self):
-        with self.finished_lock:
-            if len(self.removed) > 0:
-                for name in self.removed:
-                    logger.info('Removed: %s' % name)
-                    del self.hosts[name]
-                self.removed = []
+    def on_error(self, name, exc_info):
+        errorinfo = {'message': 'Error occurred: %s' % exc_info[0],
+                     'name': name, 'depth': self.dispatcher.depth()}
+        self.mqtt_client.publish(get_error_topic(),
+                                 payload=json.dumps(errorinfo))
+
+    def on_drop(self, name, func, args):
+        if func == self._resolve_service:
+            # Hosts which are not cached cannot be used until resolved
+            timer = threading.Timer(RESOLVE_RETRY_SEC, self.dispatcher.submit,
+                                    [name, func] + list(args))
+            timer.daemon = True
+            timer.start()
+            return
+        errorinfo = {'message': 'Dropped', 'name': name,
+                     'depth': self.dispatcher.depth()}
+        self.mqtt_client.publish(get_error_topic(),
+                                 payload=json.dumps(errorinfo))
 
+    def on_finished(self, name):
+        logger.info('Removed: %s' % name)
+        with self.lock:
+            self.router.remove(get_messages_topic(name))
+            self.router.remove(get_learn_topic(name))
+            del self.hosts[name]
+            self.cache.remove(name)
+
+
+def get_signal_key(messages):
+    data = messages.get('data', messages.get('d', []))
+    return hash((messages.get('format'), messages.get('freq'), tuple(data)))
+
+
+def encode_data(data):
+    # Deltas of the durations as zigzag varints, in base64
+    buf = bytearray()
+    last = 0
+    for value in data:
+        delta = value - last
+        last = value
+        n = (delta << 1) if delta >= 0 else ((-delta << 1) - 1)
+        while n >= 0x80:
+            buf.append((n & 0x7f) | 0x80)
+            n >>= 7
+        buf.append(n)
+    return base64.b64encode(buf)
+
+
+def decode_data(encoded):
+    data = []
+    last = 0
+    n = 0
+    shift = 0
+    for b in bytearray(base64.b64decode(encoded)):
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if b & 0x80:
+            continue
+        last += (n >> 1) if not n & 1 else -((n + 1) >> 1)
+        data.append(last)
+        n = 0
+        shift = 0
+    return data
+
+
+# Named signals persisted as a JSON file, and signals decoded from the compact
+# encoding ({"format", "freq", "c"}) cached in memory
+class SignalLibrary(object):
+
+    def __init__(self, path):
+        self.store = DeviceCache(path)
+        self.lock = threading.Lock()
+        self.decoded = OrderedDict()
+
+    def put(self, name, messages):
+        logger.info('Stored signal: %s' % name)
+        self.store.put(name, {'format': messages['format'],
+                              'freq': messages['freq'],
+                              'c': encode_data(messages['data'])})
+
+    def resolve(self, messages):
+        if 'name' in messages:
+            signal = self.store.get(messages['name'])
+            if signal is None:
+                raise ValueError('Unknown signal: %s' % messages['name'])
+            messages = signal
+        if 'c' in messages:
+            return {'format': messages['format'], 'freq': messages['freq'],
+                    'data': self._decode(messages['c'])}
+        if 'd' in messages:
+            return {'format': messages['format'], 'freq': messages['freq'],
+                    'data': messages['d']}
+        return messages
+
+    def _decode(self, encoded):
+        with self.lock:
+            if encoded in self.decoded:
+                data = self.decoded.pop(encoded)
+            else:
+                data = decode_data(encoded)
+            self.decoded[encoded] = data
+            while len(self.decoded) > DECODED_CACHE_SIZE:
+                self.decoded.popitem(last=False)
+            return data
 
-class ReceivedQueue(object):
 
-    items = []
+# Signals received from an IRKit, kept for ttl seconds so that their echo
+# from the messages topic is not sent back to the IRKit
+class EchoCache(object):
 
-    def __init__(self, size):
+    def __init__(self, size, ttl=ECHO_TTL_SEC):
         self.lock = threading.Lock()
         self.size = size
+        self.ttl = ttl
+        # signal key -> expiration time, in insertion order
+        self.items = OrderedDict()
 
     def put(self, item):
+        key = get_signal_key(item)
         with self.lock:
-            self.items.append(item)
-            if len(self.items) > self.size:
-                del self.items[-1]
+            self.items.pop(key, None)
+            self.items[key] = time.time() + self.ttl
+            self._expire()
 
     def has(self, item):
+        key = get_signal_key(item)
         with self.lock:
-            if item in self.items:
-                found = self.items.index(item)
-                del self.items[found]
+            self._expire()
+            if key in self.items:
+                del self.items[key]
                 return True
             else:
                 return False
 
+    def _expire(self):
+        now = time.time()
+        while self.items:
+            key, expires = next(self.items.iteritems())
+            if expires > now and len(self.items) <= self.size:
+                break
+            del self.items[key]
+
+
+# Serializes the requests to a host. Sends wait only for the request in
+# flight and go out back-to-back; a poll is skipped while any send is running
+# or waiting.
+class RequestScheduler(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.busy = False
+        self.waiting_sends = 0
+
+    def acquire_send(self):
+        with self.cond:
+            self.waiting_sends += 1
+            while self.busy:
+                self.cond.wait()
+            self.waiting_sends -= 1
+            self.busy = True
+
+    def try_acquire_poll(self):
+        with self.cond:
+            if self.busy or self.waiting_sends > 0:
+                return False
+            self.busy = True
+            return True
+
+    def release(self):
+        with self.cond:
+            self.busy = False
+            self.cond.notify_all()
+
+
+# Polls every host from one timer thread and a fixed pool of workers, so
+# that the number of threads does not grow with the number of hosts.
+# host.poll_once() returns the delay until its next poll, or None when the
+# host is finished.
+class PollScheduler(threading.Thread):
+
+    def __init__(self, workers=POLL_WORKERS):
+        super(PollScheduler, self).__init__()
+        self.cond = threading.Condition()
+        self.pool = ThreadPool(workers)
+        # (due time, sequence, host); entries not matching self.due are stale
+        self.heap = []
+        self.due = {}
+        self.polling = set()
+        self.woken = set()
+        self.sequence = 0
+        self.daemon = True
+
+    def add(self, host, delay=0.0):
+        with self.cond:
+            self._schedule(host, time.time() + delay)
 
-class IRKitHost(threading.Thread):
+    def wake(self, host):
+        with self.cond:
+            if host in self.polling:
+                self.woken.add(host)
+            elif host in self.due:
+                self._schedule(host, time.time())
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self._has_due():
+                    timeout = self.heap[0][0] - time.time() \
+                        if self.heap else None
+                    self.cond.wait(timeout)
+                due, _, host = heapq.heappop(self.heap)
+                if self.due.get(host) != due:
+                    continue
+                del self.due[host]
+                self.polling.add(host)
+            self.pool.apply_async(self._poll, (host,))
+
+    def _poll(self, host):
+        try:
+            delay = host.poll_once()
+        except:
+            logger.warning('Unexpected error: %s' % sys.exc_info()[0])
+            delay = host.poll_ceiling
+        with self.cond:
+            self.polling.discard(host)
+            if delay is None:
+                self.woken.discard(host)
+                return
+            if host in self.woken:
+                self.woken.discard(host)
+                delay = 0.0
+            self._schedule(host, time.time() + delay)
+
+    def _schedule(self, host, due):
+        if host in self.due and self.due[host] <= due:
+            return
+        self.due[host] = due
+        self.sequence += 1
+        heapq.heappush(self.heap, (due, self.sequence, host))
+        self.cond.notify()
+
+    def _has_due(self):
+        return self.heap and self.heap[0][0] <= time.time()
+
+
+class IRKitHost(object):
 
     on_finished = None
 
-    def __init__(self, name, address, port, mqtt_client):
-        super(IRKitHost, self).__init__()
+    def __init__(self, name, address, port, mqtt_client, library, poller,
+                 poll_floor=DEFAULT_POLL_FLOOR_SEC,
+                 poll_ceiling=DEFAULT_POLL_CEILING_SEC, compact=False):
         self.name = name
-        self.host = '%s:%d' % (str(ipaddress.ip_address(address)), port)
+        self.poller = poller
+        self.library = library
+        self.compact = compact
+        self.learning = None
+        self.poll_floor = poll_floor
+        self.poll_ceiling = poll_ceiling
+        self.poll_interval = poll_ceiling
+        self.burst_until = 0
         self.mqtt_client = mqtt_client
         self.lock = threading.RLock()
-        self.sem = threading.Semaphore()
+        self.set_address(address, port)
+        self.scheduler = RequestScheduler()
         self.service_timeout = None
-        self.daemon = True
-        self.queue = ReceivedQueue(5)
+        self.queue = EchoCache(ECHO_CACHE_SIZE)
+        self.session = self._create_session()
 
     def inactivate(self):
         with self.lock:
-            self.service_timeout = SERVICE_TIMEOUT
+            # Polls are not periodic any more, so the timeout is measured in
+            # the time SERVICE_TIMEOUT polls used to take
+            self.service_timeout = time.time() + \
+                SERVICE_TIMEOUT * CHECK_INTERVAL_SEC
 
     def activate(self):
         with self.lock:
             self.service_timeout = None
 
+    def set_address(self, address, port):
+        with self.lock:
+            self.address = str(ipaddress.ip_address(address))
+            self.port = port
+            self.host = '%s:%d' % (self.address, port)
+
     def post(self, messages):
+        messages = self.library.resolve(messages)
         if self.queue.has(messages):
             logger.debug('Skipped: already received messages')
         else:
-            if 'd' in messages:
-                messages['data'] = messages['d']
-                del messages['d']
             logger.info('Sending "%s"' % str(messages))
-            with self.sem:
-                session = requests.Session()
-                resp = session.post('http://%s/messages' % self.host,
-                                    data=json.dumps(messages),
-                                    headers={'X-Requested-With': 'homeui'},
-                                    timeout=5.0)
-                logger.debug("Response: %s (status_code=%d)" % (resp.content, resp.status_code))
-                resp.raise_for_status()
+            self.scheduler.acquire_send()
+            try:
+                resp = self.session.post('http://%s/messages' % self.host,
+                                         data=json.dumps(messages),
+                                         timeout=(CONNECT_TIMEOUT_SEC,
+                                                  SEND_TIMEOUT_SEC))
+            finally:
+                self.scheduler.release()
+            logger.debug("Response: %s (status_code=%d)" % (resp.content, resp.status_code))
+            resp.raise_for_status()
+            self.on_activity()
+
+    def _poll(self):
+        if not self.scheduler.try_acquire_poll():
+            return None
+        try:
+            return self.session.get('http://%s/messages' % self.host,
+                                    timeout=(CONNECT_TIMEOUT_SEC,
+                                             RECEIVE_TIMEOUT_SEC))
+        finally:
+            self.scheduler.release()
+
+    def _create_session(self):
+        # One keep-alive connection shared by the poll loop and the sends.
+        # Only failed connection attempts are retried, as a retried POST
+        # could send an IR signal twice.
+        session = requests.Session()
+        session.headers.update({'X-Requested-With': 'homeui'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1,
+                              max_retries=Retry(total=2, connect=2, read=0,
+                                                backoff_factor=0.1))
+        session.mount('http://', adapter)
+        return session
+
+    def learn(self, signal_name=None):
+        logger.info('Learning: %s' % self.name)
+        with self.lock:
+            self.learning = signal_name
+        self.on_activity(LEARN_WINDOW_SEC)
+
+    def on_activity(self, window=BURST_WINDOW_SEC):
+        with self.lock:
+            self.burst_until = max(self.burst_until, time.time() + window)
+            self.poll_interval = self.poll_floor
+        self.poller.wake(self)
+
+    def _next_poll_interval(self):
+        with self.lock:
+            if time.time() >= self.burst_until:
+                self.poll_interval = min(self.poll_interval * 2,
+                                         self.poll_ceiling)
+            return self.poll_interval
 
     def _is_in_service(self):
         with self.lock:
             if self.service_timeout is None:
                 return True
-            self.service_timeout -= 1
-            if self.service_timeout > 0:
-                return True
-            return False
-
-    def run(self):
-        host_info = {'status': 'added', 'name': self.name,
-                     'topic': {'messages': get_messages_topic(self.name)}}
-        self.mqtt_client.publish(get_topic(self.name),
-                                 payload=json.dumps(host_info))
+            return time.time() < self.service_timeout
 
-        while(self._is_in_service()):
-            try:
-                with self.sem:
-                    session = requests.Session()
-                    resp = session.get('http://%s/messages' % self.host,
-                                       headers={'X-Requested-With': 'homeui'},
-                                       timeout=3.0)
-                logger.debug('GET "%s" from %s (status_code=%d)' % (resp.content, self.host, resp.status_code))
-                resp.raise_for_status()
-                if resp.content:
-                    msg = resp.json()
-                    topic = get_messages_topic(self.name)
-                    self.queue.put(msg)
-                    logger.info('Publishing... %s' % topic)
-                    self.mqtt_client.publish(topic,
-                                             payload=json.dumps(msg))
-            except:
-                logger.warning('Unexpected error: %s' % sys.exc_info()[0])
-            time.sleep(CHECK_INTERVAL_SEC)
+    def _get_host_info(self, status):
+        return {'status': status, 'name': self.name,
+                'topic': {'messages': get_messages_topic(self.name),
+                          'learn': get_learn_topic(self.name)}}
 
+    def start(self):
+        self.mqtt_client.publish(get_topic(self.name),
+                                 payload=json.dumps(
+                                     self._get_host_info('added')))
+        self.poller.add(self)
+
+    def poll_once(self):
+        if not self._is_in_service():
+            self._finish()
+            return None
+        try:
+            resp = self._poll()
+            if resp is None:
+                logger.debug('Poll skipped: sending to %s' % self.host)
+                return self._next_poll_interval()
+            logger.debug('GET "%s" from %s (status_code=%d)' % (resp.content, self.host, resp.status_code))
+            resp.raise_for_status()
+            if resp.content:
+                msg = resp.json()
+                topic = get_messages_topic(self.name)
+                self.queue.put(msg)
+                with self.lock:
+                    signal_name = self.learning
+                    self.learning = None
+                if signal_name is not None:
+                    self.library.put(signal_name, msg)
+                if self.compact:
+                    msg = {'format': msg['format'], 'freq': msg['freq'],
+                           'c': encode_data(msg['data'])}
+                if signal_name is not None:
+                    msg['name'] = signal_name
+                logger.info('Publishing... %s' % topic)
+                self.mqtt_client.publish(topic,
+                                         payload=json.dumps(msg))
+                self.on_activity()
+        except:
+            logger.warning('Unexpected error: %s' % sys.exc_info()[0])
+        return self._next_poll_interval()
+
+    def _finish(self):
+        self.session.close()
         if self.on_finished:
             self.on_finished(self.name)
 
-        host_info['status'] = 'removed'
         self.mqtt_client.publish(get_topic(self.name),
-                                 payload=json.dumps(host_info))
+                                 payload=json.dumps(
+                                     self._get_host_info('removed')))
+
+
+def load_poll_settings(path):
+    with open(path) as f:
+        settings = json.load(f)
+    for name, options in settings.items():
+        if not isinstance(options, dict):
+            raise ValueError('Invalid settings of {}'.format(name))
+        for key, value in options.items():
+            if key not in ('poll_floor', 'poll_ceiling') or \
+               not isinstance(value, (int, long, float)) or value <= 0:
+                raise ValueError('Invalid setting of {}: {}={}'
+                                 .format(name, key, value))
+    return settings
 
 
 def main():
     desc = '%s [Args] [Options]\nDetailed options -h or --help' % __file__
     parser = ArgumentParser(description=desc)
     add_mqtt_arguments(parser, topic_default=DEFAULT_TOPIC_BASE)
+    add_cache_arguments(parser, 'irkit')
+    signals_default = os.path.join(DEFAULT_CACHE_DIR, 'irkit-signals.json')
+    parser.add_argument('--signals', type=str, dest='signals',
+                        default=signals_default,
+                        help='path to the library of named signals'
+                             '(default: {})'.format(signals_default))
+    parser.add_argument('--compact', dest='compact', action='store_true',
+                        help='publish received signals in compact encoding')
+    parser.add_argument('--poll-floor', type=float, dest='poll_floor',
+                        default=DEFAULT_POLL_FLOOR_SEC,
+                        help='polling interval after any activity'
+                             '(default: {})'.format(DEFAULT_POLL_FLOOR_SEC))
+    parser.add_argument('--poll-ceiling', type=float, dest='poll_ceiling',
+                        default=DEFAULT_POLL_CEILING_SEC,
+                        help='polling interval of idle IRKits'
+                             '(default: {})'.format(DEFAULT_POLL_CEILING_SEC))
+    parser.add_argument('--poll-settings', type=str, dest='poll_settings',
+                        default=None,
+                        help='JSON file of the polling intervals of each '
+                             'IRKit, {"<IRKit name>": {"poll_floor", '
+                             '"poll_ceiling"}}')
 
     args = parser.parse_args()
 
@@ -226,12 +641,24 @@ def main():
 
     logging.basicConfig(level=get_log_level(args), format=LOG_FORMAT)
 
+    poll_settings = None
+    if args.poll_settings is not None:
+        poll_settings = load_poll_settings(args.poll_settings)
+
     zeroconf = Zeroconf()
     mqtt_client = mqtt.Client()
-    listener = HostListener(mqtt_client)
+    listener = HostListener(mqtt_client, cache=DeviceCache(args.cache),
+                            library=SignalLibrary(args.signals),
+                            compact=args.compact,
+                            poll_settings=poll_settings,
+                            poll_floor=args.poll_floor,
+                            poll_ceiling=args.poll_ceiling)
     mqtt_client.on_connect = listener.on_connect
     mqtt_client.on_message = listener.on_message
     connect_mqtt(args, mqtt_client)
+    listener.dispatcher.publish_stats(mqtt_client, get_stats_topic(),
+                                      STATS_INTERVAL_SEC)
+    listener.load_cache()
     browser = ServiceBrowser(zeroconf, SERVICE_TYPE, listener)
     try:
         mqtt_client.loop_forever()
@@ -11,8 +11,15 @@ from common import *
 import Queue
 import json
 import sys
+import re
+import bisect
 
 DEFAULT_TOPIC_BASE = 'itunes/'
+LIBRARY_REFRESH_SEC = 60 * 10
+MAX_INCREMENTAL_TRACKS = 200
+MAX_POLL_INTERVAL_SEC = 10.0
+IDLE_POLLS_BEFORE_BACKOFF = 30
+STATS_INTERVAL_SEC = 60.0
 
 topic_base = DEFAULT_TOPIC_BASE
 logger = logging.getLogger()
@@ -63,6 +70,17 @@ on play_track(track_name, track_artist, track_album, playlist_name)
     end tell
 end play_track
 
+on apply_action(action_name, track_name, track_artist, track_album, playlist_name)
+    if action_name is "play" then
+        my play_track(track_name, track_artist, track_album, playlist_name)
+    else if action_name is "pause" then
+        my pause_track()
+    else if action_name is "stop" then
+        my stop_track()
+    end if
+    return my current_state()
+end apply_action
+
 on search_for_playlist(track_name, playlist_name)
     tell application "iTunes"
         set target_playlist to (user playlist playlist_name)
@@ -100,17 +118,223 @@ on search_for_artist(artist_name)
         return infos
     end tell
 end search_for_artist
+
+on export_library()
+    tell application "iTunes"
+        set music_playlist to (get some playlist whose special kind is Music)
+        set music_tracks to every track of music_playlist
+        return {playlist_name: name of music_playlist, track_ids: database ID of music_tracks, track_names: name of music_tracks, track_artists: artist of music_tracks, track_albums: album of music_tracks, modified: modification date of music_tracks}
+    end tell
+end export_library
+
+on library_revision()
+    tell application "iTunes"
+        set music_playlist to (get some playlist whose special kind is Music)
+        set music_tracks to every track of music_playlist
+        return {track_ids: database ID of music_tracks, modified: modification date of music_tracks}
+    end tell
+end library_revision
+
+on export_tracks(track_ids)
+    tell application "iTunes"
+        set music_playlist to (get some playlist whose special kind is Music)
+        set infos to {}
+        repeat with track_id in track_ids
+            set t to (first track of music_playlist whose database ID is (track_id as integer))
+            set the end of infos to {track_id: database ID of t, track_name: name of t, track_artist: artist of t, track_album: album of t, modified: modification date of t}
+        end repeat
+        return infos
+    end tell
+end export_tracks
+
+on export_playlists()
+    tell application "iTunes"
+        set infos to {}
+        repeat with p in (every user playlist)
+            set the end of infos to {playlist_name: name of p, track_ids: database ID of every track of p}
+        end repeat
+        return infos
+    end tell
+end export_playlists
 ''')
 
 
+# In-memory copy of the library with inverted indexes from the words of
+# track names, artists and albums, and from playlists to tracks
+class LibraryIndex(object):
+
+    FIELDS = ['track_name', 'track_artist', 'track_album']
+    WORD = re.compile(r'\w+', re.UNICODE)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.music_playlist = None
+        self.tracks = {}
+        self.words = dict([(f, {}) for f in self.FIELDS])
+        self.sorted_words = {}
+        self.playlists = {}
+        self.next_order = 0
+
+    def load(self, library):
+        with self.lock:
+            self.music_playlist = library['playlist_name']
+            self.tracks = {}
+            self.words = dict([(f, {}) for f in self.FIELDS])
+            self.next_order = 0
+            for values in zip(library['track_ids'], library['track_names'],
+                              library['track_artists'],
+                              library['track_albums'], library['modified']):
+                self._put(dict(zip(['track_id'] + self.FIELDS + ['modified'],
+                                   values)))
+            self.sorted_words = {}
+            self.loaded = True
+
+    def put(self, tracks):
+        with self.lock:
+            for track in tracks:
+                self._put(track)
+            self.sorted_words = {}
+
+    def remove(self, track_ids):
+        with self.lock:
+            for track_id in track_ids:
+                self._remove(track_id)
+            self.sorted_words = {}
+
+    def set_playlists(self, playlists):
+        with self.lock:
+            self.playlists = dict([(p['playlist_name'], set(p['track_ids']))
+                                   for p in playlists])
+
+    def get_changes(self, revision):
+        # Returns IDs of added or modified tracks and IDs of removed tracks
+        with self.lock:
+            changed = [track_id for track_id, modified
+                       in zip(revision['track_ids'], revision['modified'])
+                       if track_id not in self.tracks or
+                       self.tracks[track_id]['modified'] != modified]
+            removed = set(self.tracks.keys()) - set(revision['track_ids'])
+        return changed, removed
+
+    def find(self, track_info):
+        with self.lock:
+            if 'playlist_name' in track_info:
+                playlist_name = track_info['playlist_name']
+                # User playlists may have tracks out of the Music playlist
+                ids = set([i for i in self.playlists.get(playlist_name, [])
+                           if i in self.tracks])
+            elif 'track_album' in track_info or 'track_artist' in track_info:
+                playlist_name = self.music_playlist
+                ids = set(self.tracks.keys())
+            else:
+                raise ValueError('Insufficient parameters: {}'
+                                 .format(track_info))
+            for field in self.FIELDS:
+                if field not in track_info:
+                    continue
+                ids = self._search(field, track_info[field], ids)
+            tracks = sorted([self.tracks[i] for i in ids],
+                            key=lambda t: t['order'])
+        return [{'track_name': t['track_name'],
+                 'track_artist': t['track_artist'],
+                 'track_album': t['track_album'],
+                 'playlist_name': playlist_name} for t in tracks]
+
+    def _search(self, field, text, ids):
+        # Words of the text narrow down the candidates. A word in the middle
+        # of the text is a whole word of the field, the last one is a prefix
+        # of a word, the first one is a suffix, and a text of a single word
+        # can be any part of a word.
+        text = self._decode(text)
+        normalized = text.lower()
+        for match in self.WORD.finditer(normalized):
+            word = match.group()
+            at_start = match.start() == 0
+            at_end = match.end() == len(normalized)
+            if at_start and at_end:
+                matched = self._lookup_words(field, lambda w: word in w)
+            elif at_start:
+                matched = self._lookup_words(field, lambda w: w.endswith(word))
+            elif at_end:
+                matched = self._lookup_prefix(field, word)
+            else:
+                matched = self.words[field].get(word, set())
+            ids = ids & matched
+        # The whole text must be contained as the filters of the AppleScript
+        # search did, case-sensitively
+        return set([i for i in ids
+                    if text in self._decode(self.tracks[i][field])])
+
+    def _lookup_words(self, field, predicate):
+        ids = set()
+        for word, word_ids in self.words[field].items():
+            if predicate(word):
+                ids |= word_ids
+        return ids
+
+    def _lookup_prefix(self, field, prefix):
+        if field not in self.sorted_words:
+            self.sorted_words[field] = sorted(self.words[field].keys())
+        words = self.sorted_words[field]
+        ids = set()
+        pos = bisect.bisect_left(words, prefix)
+        while pos < len(words) and words[pos].startswith(prefix):
+            ids |= self.words[field][words[pos]]
+            pos += 1
+        return ids
+
+    def _decode(self, text):
+        if text is None:
+            return u''
+        if not isinstance(text, unicode):
+            text = text.decode('utf8')
+        return text
+
+    def _normalize(self, text):
+        return self._decode(text).lower()
+
+    def _put(self, track):
+        track_id = track['track_id']
+        if track_id in self.tracks:
+            order = self.tracks[track_id]['order']
+            self._remove(track_id)
+        else:
+            order = self.next_order
+            self.next_order += 1
+        track = dict(track)
+        track['order'] = order
+        self.tracks[track_id] = track
+        for field in self.FIELDS:
+            for word in set(self.WORD.findall(self._normalize(track[field]))):
+                self.words[field].setdefault(word, set()).add(track_id)
+
+    def _remove(self, track_id):
+        track = self.tracks.pop(track_id, None)
+        if track is None:
+            return
+        for field in self.FIELDS:
+            for word in set(self.WORD.findall(self._normalize(track[field]))):
+                ids = self.words[field].get(word)
+                if ids is None:
+                    continue
+                ids.discard(track_id)
+                if not ids:
+                    del self.words[field][word]
+
+
 class LibraryBrowser(threading.Thread):
 
-    def __init__(self, itunes_id, mqtt_client, interval=1.0):
+    def __init__(self, itunes_id, mqtt_client, interval=1.0,
+                 max_interval=MAX_POLL_INTERVAL_SEC):
         super(LibraryBrowser, self).__init__()
         self.mqtt_client = mqtt_client
         self.itunes_id = itunes_id
         self.interval = interval
+        self.max_interval = max(interval, max_interval)
+        self.calls = {}
         self.actions = Queue.Queue()
+        self.library = LibraryIndex()
         self.lock = threading.Lock()
         self.in_service = True
         self.daemon = True
@@ -139,43 +363,91 @@ class LibraryBrowser(threading.Thread):
         last_state = None
         logger.debug('Register: {}'.format(self.itunes_id))
         self._on_added()
+        refresher = threading.Thread(target=self._refresh_loop)
+        refresher.daemon = True
+        refresher.start()
         try:
             next_action = None
+            interval = self.interval
+            idle_polls = 0
+            last_stats = time.time()
             while(self._in_service()):
-                state = script.call('current_state')
                 try:
+                    # The action and the poll of the state are one Apple Event
+                    action = ['']
                     if next_action:
                         if next_action['state'] == 'playing':
                             if last_state != next_action:
                                 last_state = next_action
                                 logger.info('Play: {}'.format(next_action))
-                                script.call('play_track', next_action['track_name'], next_action['track_artist'], next_action['track_album'], next_action['playlist_name'])
+                                action = ['play', next_action['track_name'], next_action['track_artist'], next_action['track_album'], next_action['playlist_name']]
                             else:
                                 logger.debug('Skipped: {}'.format(next_action))
                         elif last_state and last_state['state'] != next_action['state']:
                             logger.info('Apply: {}'.format(next_action))
                             if next_action['state'] == 'paused':
                                 last_state['state'] = next_action['state']
-                                script.call('pause_track')
+                                action = ['pause']
                             elif next_action['state'] == 'stopped':
                                 last_state = next_action
-                                script.call('stop_track')
+                                action = ['stop']
                         else:
                             logger.debug('Skipped: {}'.format(next_action))
+                    args = action + [''] * (5 - len(action))
+                    state = self._call('apply_action', *args)
+                    if next_action:
+                        idle_polls = 0
                     elif not last_state or state != last_state:
                         logger.info('Changed: {}'.format(state))
                         self.mqtt_client.publish(self._get_topic('current'),
                                                  payload=json.dumps(state))
                         last_state = state
+                        idle_polls = 0
+                    else:
+                        idle_polls += 1
                 except:
                     logger.error('Unexpected error: %s' % sys.exc_info()[0])
+                # Polls slow down while nothing changes, and actions are
+                # still taken as soon as they are queued
+                if idle_polls >= IDLE_POLLS_BEFORE_BACKOFF:
+                    interval = min(interval * 1.5, self.max_interval)
+                else:
+                    interval = self.interval
+                if last_stats + STATS_INTERVAL_SEC <= time.time():
+                    self._publish_stats()
+                    last_stats = time.time()
                 try:
-                    next_action = self.actions.get(True, self.interval)
+                    next_action = self.actions.get(True, interval)
                 except Queue.Empty:
                     next_action = None
         finally:
             self._on_removed()
 
+    def _call(self, name, *args):
+        started = time.time()
+        try:
+            return script.call(name, *args)
+        finally:
+            elapsed = time.time() - started
+            logger.debug('AppleScript: {} {:.3f}s'.format(name, elapsed))
+            with self.lock:
+                stats = self.calls.setdefault(name, {'count': 0,
+                                                     'total': 0.0,
+                                                     'max': 0.0})
+                stats['count'] += 1
+                stats['total'] += elapsed
+                stats['max'] = max(stats['max'], elapsed)
+
+    def _publish_stats(self):
+        with self.lock:
+            stats = dict([(name, {'count': c['count'], 'max': c['max'],
+                                  'avg': c['total'] / c['count']})
+                          for name, c in self.calls.items()])
+            self.calls = {}
+        logger.debug('Stats: %s' % str(stats))
+        self.mqtt_client.publish(self._get_topic('stats'),
+                                 payload=json.dumps(stats))
+
     def _in_service(self):
         with self.lock:
             return self.in_service
@@ -189,24 +461,65 @@ class LibraryBrowser(threading.Thread):
     def _on_added(self):
         host_info = {'status': 'added', 'itunes': self.itunes_id,
                      'topic': {'current': self._get_topic('current'),
-                               'candidates': self._get_topic('candidates')}}
+                               'candidates': self._get_topic('candidates'),
+                               'stats': self._get_topic('stats')}}
         self.mqtt_client.publish(self._get_topic(),
                                  payload=json.dumps(host_info))
 
     def _on_removed(self):
         host_info = {'status': 'removed', 'itunes': self.itunes_id,
                      'topic': {'current': self._get_topic('current'),
-                               'candidates': self._get_topic('candidates')}}
+                               'candidates': self._get_topic('candidates'),
+                               'stats': self._get_topic('stats')}}
         self.mqtt_client.publish(self._get_topic(),
                                  payload=json.dumps(host_info))
 
+    def _refresh_loop(self):
+        # Exporting a large library takes seconds, so it is not done between
+        # the actions and the polls
+        while(self._in_service()):
+            self._refresh_library()
+            time.sleep(LIBRARY_REFRESH_SEC)
+
+    def _refresh_library(self):
+        try:
+            if not self.library.loaded:
+                self.library.load(self._call('export_library'))
+            else:
+                revision = self._call('library_revision')
+                changed, removed = self.library.get_changes(revision)
+                if len(changed) > MAX_INCREMENTAL_TRACKS:
+                    self.library.load(self._call('export_library'))
+                else:
+                    if changed:
+                        self.library.put(self._call('export_tracks',
+                                                    changed))
+                    if removed:
+                        self.library.remove(removed)
+                logger.debug('Library: {} changed, {} removed'
+                             .format(len(changed), len(removed)))
+            self.library.set_playlists(self._call('export_playlists'))
+        except:
+            logger.warning('Unexpected error: %s' % sys.exc_info()[0])
+
     def _on_play(self, track_info):
+        if self.library.loaded:
+            results = self.library.find(track_info)
+        else:
+            results = self._search(track_info)
+        logger.info('Search result: {}'.format(results))
+        self.mqtt_client.publish(self._get_topic('candidates'), payload=json.dumps(results))
+        if len(results) == 1:
+            self.actions.put(dict(results[0].items() + [('state', 'playing')]))
+
+    def _search(self, track_info):
+        # Used until the library is loaded
         if 'playlist_name' in track_info:
-            results = script.call('search_for_playlist', track_info['track_name'], track_info['playlist_name'])
+            results = self._call('search_for_playlist', track_info['track_name'], track_info['playlist_name'])
         elif 'track_album' in track_info:
-            results = script.call('search_for_album', track_info['track_album'])
+            results = self._call('search_for_album', track_info['track_album'])
         elif 'track_artist' in track_info:
-            results = script.call('search_for_artist', track_info['track_artist'])
+            results = self._call('search_for_artist', track_info['track_artist'])
         else:
             raise ValueError('Insufficient parameters: {}'.format(track_info))
         if 'track_album' in track_info:
@@ -215,10 +528,7 @@ class LibraryBrowser(threading.Thread):
             results = filter(lambda i: track_info['track_artist'] in i['track_artist'], results)
         if 'track_name' in track_info:
             results = filter(lambda i: track_info['track_name'] in i['track_name'], results)
-        logger.info('Search result: {}'.format(results))
-        self.mqtt_client.publish(self._get_topic('candidates'), payload=json.dumps(results))
-        if len(results) == 1:
-            self.actions.put(dict(results[0].items() + [('state', 'playing')]))
+        return results
 
 
 def main():
@@ -227,6 +537,10 @@ def main():
     add_mqtt_arguments(parser, topic_default=DEFAULT_TOPIC_BASE)
     parser.add_argument('-i', '--id', type=str, dest='itunes_id', required=True,
                         help='ID for the iTunes')
+    parser.add_argument('--max-interval', type=float, dest='max_interval',
+                        default=MAX_POLL_INTERVAL_SEC,
+                        help='Max interval of polls while iTunes is idle '
+                             '(default: {})'.format(MAX_POLL_INTERVAL_SEC))
 
     args = parser.parse_args()
 
@@ -236,7 +550,8 @@ def main():
     logging.basicConfig(level=get_log_level(args), format=LOG_FORMAT)
 
     mqtt_client = mqtt.Client()
-    browser = LibraryBrowser(args.itunes_id, mqtt_client)
+    browser = LibraryBrowser(args.itunes_id, mqtt_client,
+                             max_interval=args.max_interval)
     mqtt_client.on_connect = browser.on_connect
     mqtt_client.on_message = browser.on_message
     connect_mqtt(args, mqtt_client)
@@ -9,15 +9,160 @@ import paho.mqtt.client as mqtt
 import logging
 import logging.config
 import json
+import threading
+import ipaddress
+from zeroconf import ServiceBrowser, Zeroconf
 from argparse import ArgumentParser
 from common import *
 
 DEFAULT_TOPIC_BASE = 'nature/'
 
 topic_base = DEFAULT_TOPIC_BASE
+dispatcher = None
+registry = None
+remos = None
+local_signals = {}
+session = requests.Session()
+pending = {}
+pending_lock = threading.Lock()
 logger = logging.getLogger()
 
 NATURE_API_URL = 'https://api.nature.global'
+REGISTRY_TTL_SEC = 300.0
+# Minimum interval of the refreshes caused by unknown topics
+REGISTRY_MISS_INTERVAL_SEC = 10.0
+# Background requests wait for the reset while fewer requests than this
+# remain, so that interactive commands can still be sent
+BACKGROUND_RESERVE = 10
+DEFAULT_RETRY_AFTER_SEC = 10.0
+
+DEFAULT_DEVICE_INTERVAL_SEC = 60.0
+# newest_events key -> (topic name, deadband); events without a deadband are
+# published whenever they occur
+SENSORS = {'te': ('temperature', 0.2), 'hu': ('humidity', 1.0),
+           'il': ('illuminance', 5.0), 'mo': ('motion', None)}
+
+REMO_SERVICE_TYPE = '_remo._tcp.local.'
+LOCAL_TIMEOUT_SEC = 3.0
+# Resolutions of services dropped by the dispatcher are submitted again
+RESOLVE_RETRY_SEC = 5.0
+
+INTERACTIVE = 0
+BACKGROUND = 1
+# Buttons which set a state, so that pressing one twice in a row is the same
+# as pressing it once. Other buttons (onoff, bright-up, ...) change the state
+# relatively, and every press is sent.
+ABSOLUTE_BUTTONS = set(['on', 'on-100', 'on-favorite', 'off', 'night'])
+
+
+# Tracks the X-Rate-Limit-* headers of the API and delays requests while the
+# budget is low. Interactive requests are served before background ones.
+class RateLimiter(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.remaining = None
+        self.reset = 0
+        self.waiting_interactive = 0
+
+    def request(self, method, url, priority=INTERACTIVE, **kwargs):
+        for attempt in range(2):
+            self._acquire(priority)
+            res = session.request(method, url, **kwargs)
+            self._update(res)
+            if res.status_code != 429:
+                return res
+            logger.warning('Rate limited: %s %s' % (method, url))
+        return res
+
+    def _acquire(self, priority):
+        with self.cond:
+            if priority == INTERACTIVE:
+                self.waiting_interactive += 1
+            try:
+                while True:
+                    wait = self._get_wait(priority)
+                    if wait <= 0:
+                        break
+                    logger.info('Waiting for the rate limit: %.1f sec' % wait)
+                    self.cond.wait(wait)
+                if self.remaining is not None:
+                    self.remaining -= 1
+            finally:
+                if priority == INTERACTIVE:
+                    self.waiting_interactive -= 1
+                    self.cond.notify_all()
+
+    def _get_wait(self, priority):
+        now = time.time()
+        if self.reset <= now:
+            if priority == BACKGROUND and self.waiting_interactive > 0:
+                return 0.1
+            return 0
+        reserve = BACKGROUND_RESERVE if priority == BACKGROUND else 0
+        if self.remaining is not None and self.remaining <= reserve:
+            return self.reset - now
+        if priority == BACKGROUND and self.waiting_interactive > 0:
+            return 0.1
+        return 0
+
+    def _update(self, res):
+        with self.cond:
+            if 'x-rate-limit-remaining' in res.headers:
+                self.remaining = int(res.headers['x-rate-limit-remaining'])
+            if 'x-rate-limit-reset' in res.headers:
+                self.reset = float(res.headers['x-rate-limit-reset'])
+            if res.status_code == 429:
+                self.remaining = 0
+                if self.reset <= time.time():
+                    retry_after = res.headers.get('retry-after')
+                    self.reset = time.time() + \
+                        (float(retry_after) if retry_after
+                         else DEFAULT_RETRY_AFTER_SEC)
+            self.cond.notify_all()
+
+
+limiter = RateLimiter()
+
+
+# Nature Remos on the LAN, discovered by zeroconf
+class RemoListener(object):
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def remove_service(self, zeroconf, type, name):
+        logger.info('Remo %s removed' % (name,))
+        with self.lock:
+            self.hosts.pop(name, None)
+
+    def add_service(self, zeroconf, type, name):
+        # get_service_info blocks the thread of zeroconf, so the address is
+        # resolved by the dispatcher
+        self.dispatcher.submit(name, self._resolve_service, zeroconf, type,
+                               name)
+
+    def _resolve_service(self, zeroconf, type, name):
+        info = zeroconf.get_service_info(type, name)
+        logger.info('Remo %s added, service info: %s' % (name, info))
+        if info:
+            with self.lock:
+                self.hosts[name] = '%s:%d' % (
+                    str(ipaddress.ip_address(info.address)), info.port)
+
+    def get_host(self, device):
+        # Remos are advertised as Remo-XXXXXX, where XXXXXX is the end of
+        # the MAC address
+        mac = device.get('mac_address', '').replace(':', '').upper()
+        with self.lock:
+            for name, host in self.hosts.items():
+                if mac and mac[-6:] in name.upper():
+                    return host
+            if len(self.hosts) == 1:
+                return self.hosts.values()[0]
+        return None
 
 
 class NatureAppliance:
@@ -31,10 +176,16 @@ class NatureAppliance:
         return get_topic(name) + '/light'
 
     def post(self, command):
+        # Returns the path used for the command, 'local' or 'cloud'
         id = self.appliance['id']
         logger.info('Post: {} <- {}'.format(id, command))
         assert 'button' in command
-        res = requests.post(
+        signal = local_signals.get(self.appliance['nickname'], {}) \
+                              .get(command['button'])
+        if signal is not None and self._post_local(signal):
+            return 'local'
+        res = limiter.request(
+            'POST',
             '{}/1/appliances/{}/light?button={}'.format(
                 NATURE_API_URL,
                 id,
@@ -43,6 +194,24 @@ class NatureAppliance:
             headers=_nature_request_headers(),
         )
         res.raise_for_status()
+        return 'cloud'
+
+    def _post_local(self, signal):
+        host = remos.get_host(self.appliance.get('device', {})) \
+            if remos is not None else None
+        if host is None:
+            return False
+        try:
+            res = session.post('http://{}/messages'.format(host),
+                               data=json.dumps(signal),
+                               headers={'X-Requested-With': 'local'},
+                               timeout=LOCAL_TIMEOUT_SEC)
+            res.raise_for_status()
+            return True
+        except IOError:
+            logger.warning('Local request to {} failed: {}'.format(
+                host, sys.exc_info()[1]))
+            return False
 
 def get_topic(name):
     return topic_base + name.encode('utf8')
@@ -54,13 +223,135 @@ def _nature_request_headers():
         'authorization': 'Bearer {}'.format(token),
     }
 
-def get_nature_appliances():
-    res = requests.get(
+def get_nature_appliances(etag=None, priority=INTERACTIVE):
+    # Returns (appliances, etag), or (None, etag) if not modified
+    headers = _nature_request_headers()
+    if etag is not None:
+        headers['if-none-match'] = etag
+    res = limiter.request(
+        'GET',
         '{}/1/appliances'.format(NATURE_API_URL),
-        headers=_nature_request_headers(),
+        priority=priority,
+        headers=headers,
     )
+    if res.status_code == 304:
+        return None, etag
     res.raise_for_status()
-    return [NatureAppliance(a) for a in res.json()]
+    return [NatureAppliance(a) for a in res.json()], res.headers.get('etag')
+
+
+class ApplianceRegistry(threading.Thread):
+
+    def __init__(self, ttl=REGISTRY_TTL_SEC):
+        super(ApplianceRegistry, self).__init__()
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.appliances = []
+        self.router = TopicRouter()
+        self.etag = None
+        self.refreshed = 0
+        self.daemon = True
+
+    def get_all(self):
+        with self.lock:
+            return list(self.appliances)
+
+    def get(self, topic):
+        appliance = self.router.get(topic)
+        if appliance is None and \
+           self.refreshed + REGISTRY_MISS_INTERVAL_SEC <= time.time():
+            logger.info('Unknown topic, refreshing: %s' % topic)
+            self.refresh()
+            appliance = self.router.get(topic)
+        return appliance
+
+    def refresh(self, priority=INTERACTIVE):
+        with self.refresh_lock:
+            appliances, self.etag = get_nature_appliances(self.etag, priority)
+            self.refreshed = time.time()
+            if appliances is None:
+                logger.debug('Appliances not modified')
+                return
+            logger.debug('Appliances: %d' % len(appliances))
+            with self.lock:
+                for appliance in self.appliances:
+                    if appliance.get_light_topic() is not None:
+                        self.router.remove(appliance.get_light_topic())
+                self.appliances = appliances
+                for appliance in appliances:
+                    if appliance.get_light_topic() is not None:
+                        self.router.add(appliance.get_light_topic(),
+                                        appliance)
+
+    def run(self):
+        while True:
+            time.sleep(self.ttl)
+            try:
+                self.refresh(BACKGROUND)
+            except:
+                logger.warning('Unexpected error: %s' % sys.exc_info()[0])
+
+def get_nature_devices(etag=None, priority=BACKGROUND):
+    # Returns (devices, etag), or (None, etag) if not modified
+    headers = _nature_request_headers()
+    if etag is not None:
+        headers['if-none-match'] = etag
+    res = limiter.request(
+        'GET',
+        '{}/1/devices'.format(NATURE_API_URL),
+        priority=priority,
+        headers=headers,
+    )
+    if res.status_code == 304:
+        return None, etag
+    res.raise_for_status()
+    return res.json(), res.headers.get('etag')
+
+
+class DeviceMonitor(threading.Thread):
+
+    def __init__(self, mqtt_client, interval=DEFAULT_DEVICE_INTERVAL_SEC):
+        super(DeviceMonitor, self).__init__()
+        self.mqtt_client = mqtt_client
+        self.interval = interval
+        self.etag = None
+        # (device id, sensor) -> last published event
+        self.last_events = {}
+        self.daemon = True
+
+    def run(self):
+        while True:
+            try:
+                self.check()
+            except:
+                logger.warning('Unexpected error: %s' % sys.exc_info()[0])
+            time.sleep(self.interval)
+
+    def check(self):
+        devices, self.etag = get_nature_devices(self.etag)
+        if devices is None:
+            return
+        for device in devices:
+            events = device.get('newest_events', {})
+            for key, (sensor, deadband) in SENSORS.items():
+                if key in events:
+                    self._update(device, key, sensor, deadband, events[key])
+
+    def _update(self, device, key, sensor, deadband, event):
+        last = self.last_events.get((device['id'], key))
+        if last is not None:
+            if deadband is None:
+                if last['created_at'] == event['created_at']:
+                    return
+            elif abs(last['val'] - event['val']) < deadband:
+                return
+        self.last_events[(device['id'], key)] = event
+        topic = '{}/{}'.format(get_topic(device['name']), sensor)
+        logger.info('Publishing... {} {}'.format(topic, event['val']))
+        self.mqtt_client.publish(topic, payload=json.dumps(
+            {'value': event['val'], 'created_at': event['created_at']}),
+            retain=True)
 
 def get_error_topic():
     return topic_base + 'error'
@@ -73,28 +364,107 @@ def nature_on_message(client, userdata, msg):
     try:
         logger.info('Received: %s, %s' % (msg.topic, msg.payload))
         command = json.loads(msg.payload)
+        if not isinstance(command, dict):
+            raise ValueError('Invalid command: {}'.format(command))
         assert(msg.topic.startswith(topic_base))
         topic_sub = msg.topic[len(topic_base):]
         assert(topic_sub.endswith('/light'))
-        to = topic_sub[:-len('/light')]
-        appliances = get_nature_appliances()
-        if to == 'all':
-            for host in appliances:
-                host.post(command)
+        # Cloud requests are run by the dispatcher so that they do not block
+        # the network thread of paho. A command which repeats the absolute
+        # button waiting last for the same topic is not sent again.
+        with pending_lock:
+            commands = pending.setdefault(msg.topic, [])
+            coalesced = len(commands) > 0 and commands[-1] == command and \
+                command.get('button') in ABSOLUTE_BUTTONS
+            if not coalesced:
+                commands.append(command)
+        if coalesced:
+            logger.info('Coalesced: %s, %s' % (msg.topic, command))
         else:
-            for host in appliances:
-                if host.get_light_topic() == msg.topic.encode('utf8'):
-                    host.post(command)
+            dispatcher.submit(msg.topic, nature_post_pending, client,
+                              msg.topic)
     except (ValueError, IOError):
         logger.error('Unexpected error: %s' % sys.exc_info()[0])
         errorinfo = {'message': 'Error occurred: %s' % sys.exc_info()[0]}
         client.publish(get_error_topic(), payload=json.dumps(errorinfo))
 
 
+def _pop_pending(topic):
+    # Each job of a topic sends the oldest of its pending commands
+    with pending_lock:
+        commands = pending.get(topic)
+        if not commands:
+            return None
+        command = commands.pop(0)
+        if not commands:
+            del pending[topic]
+        return command
+
+
+def nature_post_pending(client, topic):
+    command = _pop_pending(topic)
+    if command is not None:
+        nature_post(client, topic, command)
+
+
+def nature_post(client, topic, command):
+    to = topic[len(topic_base):-len('/light')]
+    if to == 'all':
+        for host in registry.get_all():
+            _publish_result(client, host, command, host.post(command))
+    else:
+        host = registry.get(topic.encode('utf8'))
+        if host is not None:
+            _publish_result(client, host, command, host.post(command))
+        else:
+            logger.warning('Unknown appliance: %s' % topic)
+
+
+def _publish_result(client, host, command, path):
+    logger.info('Sent via {}: {}'.format(path, host.appliance['id']))
+    result = {'command': command, 'path': path}
+    client.publish(get_topic(host.appliance['nickname']) + '/result',
+                   payload=json.dumps(result))
+
+
+def nature_on_drop(client, topic, func, args):
+    # The command stays pending only while its job is queued, or later
+    # commands for the topic would be coalesced into a job which never runs
+    command = None
+    if func == nature_post_pending:
+        command = _pop_pending(topic)
+    elif remos is not None and func == remos._resolve_service:
+        timer = threading.Timer(RESOLVE_RETRY_SEC, dispatcher.submit,
+                                [topic, func] + list(args))
+        timer.daemon = True
+        timer.start()
+        return
+    errorinfo = {'message': 'Dropped', 'topic': topic, 'command': command,
+                 'depth': dispatcher.depth()}
+    client.publish(get_error_topic(), payload=json.dumps(errorinfo))
+
+
+def nature_on_error(client, topic, exc_info):
+    errorinfo = {'message': 'Error occurred: %s' % exc_info[0],
+                 'topic': topic, 'depth': dispatcher.depth()}
+    client.publish(get_error_topic(), payload=json.dumps(errorinfo))
+
+
 def main():
     desc = '%s [Args] [Options]\nDetailed options -h or --help' % __file__
     parser = ArgumentParser(description=desc)
     add_mqtt_arguments(parser, topic_default=DEFAULT_TOPIC_BASE)
+    parser.add_argument('--local-signals', type=str, dest='local_signals',
+                        default=None,
+                        help='JSON file of IR signals for the local API, '
+                             '{"<nickname>": {"<button>": {"format", "freq", '
+                             '"data"}}}')
+    parser.add_argument('--device-interval', type=float,
+                        dest='device_interval',
+                        default=DEFAULT_DEVICE_INTERVAL_SEC,
+                        help='interval to check the sensors of Remos, '
+                             '0 to disable(default: {})'
+                             .format(DEFAULT_DEVICE_INTERVAL_SEC))
 
     args = parser.parse_args()
 
@@ -106,13 +476,42 @@ def main():
     assert 'NATURE_TOKEN' in os.environ
 
     mqtt_client = mqtt.Client()
+    global dispatcher
+    dispatcher = Dispatcher(
+        on_error=lambda topic, exc_info: nature_on_error(mqtt_client, topic,
+                                                         exc_info),
+        on_drop=lambda topic, func, args: nature_on_drop(mqtt_client, topic,
+                                                         func, args))
+
+    global local_signals, remos
+    if args.local_signals is not None:
+        with open(args.local_signals) as f:
+            local_signals = json.load(f)
+    zeroconf = Zeroconf()
+    remos = RemoListener(dispatcher)
+    browser = ServiceBrowser(zeroconf, REMO_SERVICE_TYPE, remos)
+
+    global registry
+    registry = ApplianceRegistry()
+    try:
+        registry.refresh()
+    except (ValueError, IOError):
+        logger.warning('Failed to load appliances: %s' % sys.exc_info()[0])
+    registry.start()
+
     mqtt_client.on_connect = nature_on_connect
     mqtt_client.on_message = nature_on_message
     connect_mqtt(args, mqtt_client)
+    dispatcher.publish_stats(mqtt_client, topic_base + 'stats')
+    if args.device_interval > 0:
+        monitor = DeviceMonitor(mqtt_client, interval=args.device_interval)
+        monitor.start()
     try:
         mqtt_client.loop_forever()
     except KeyboardInterrupt:
         pass
+    finally:
+        zeroconf.close()
 
 if __name__ == '__main__':
     main()
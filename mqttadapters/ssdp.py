@@ -13,45 +13,203 @@
 #   limitations under the License.
 
 import socket
-import httplib
-import StringIO
+import select
+import struct
+import threading
+import time
+import logging
+
+SSDP_GROUP = ("239.255.255.250", 1900)
+MAX_DATAGRAM_SIZE = 65507
+DEFAULT_MAX_AGE = 1800
+# Devices are searched at least this many times within their max-age, and
+# expire only after this many more searches, so that a lost response does
+# not remove them
+SEARCHES_PER_MAX_AGE = 4
+EXPIRY_GRACE_SEARCHES = 2
+MIN_SEARCH_INTERVAL = 1.0
+
+logger = logging.getLogger()
+
+
+def parse_message(data):
+    lines = data.split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
 
 class SSDPResponse(object):
-    class _FakeSocket(StringIO.StringIO):
-        def makefile(self, *args, **kw):
-            return self
     def __init__(self, response):
-        r = httplib.HTTPResponse(self._FakeSocket(response))
-        r.begin()
-        self.location = r.getheader("location")
-        self.usn = r.getheader("usn")
-        self.st = r.getheader("st")
-        self.cache = r.getheader("cache-control").split("=")[1]
+        start_line, headers = parse_message(response)
+        self.method = start_line.split(" ", 1)[0]
+        self.location = headers.get("location")
+        self.usn = headers.get("usn")
+        # NOTIFY messages carry the type as NT instead of ST
+        self.st = headers.get("st", headers.get("nt"))
+        self.nts = headers.get("nts")
+        self.cache = None
+        cache_control = headers.get("cache-control", "")
+        if "=" in cache_control:
+            self.cache = cache_control.split("=")[1].strip()
+    def get_max_age(self):
+        try:
+            return int(self.cache)
+        except (TypeError, ValueError):
+            return DEFAULT_MAX_AGE
     def __repr__(self):
         return "<SSDPResponse({location}, {st}, {usn})>".format(**self.__dict__)
 
-def discover(service, timeout=2, retries=1):
-    group = ("239.255.255.250", 1900)
-    message = "\r\n".join([
+def get_search_message(service):
+    return "\r\n".join([
         'M-SEARCH * HTTP/1.1',
         'HOST: {0}:{1}',
         'MAN: "ssdp:discover"',
-        'ST: {st}','MX: 3','',''])
-    socket.setdefaulttimeout(timeout)
+        'ST: {st}','MX: 3','','']).format(*SSDP_GROUP, st=service)
+
+def discover(service, timeout=2, retries=1):
+    message = get_search_message(service)
     responses = {}
     for _ in range(retries):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-        sock.sendto(message.format(*group, st=service), group)
+        # Only this socket times out; socket.setdefaulttimeout would affect
+        # every socket of the process
+        sock.settimeout(timeout)
+        sock.sendto(message, SSDP_GROUP)
         while True:
             try:
-                response = SSDPResponse(sock.recv(1024))
+                response = SSDPResponse(sock.recv(MAX_DATAGRAM_SIZE))
                 responses[response.location] = response
             except socket.timeout:
                 break
+        sock.close()
     return responses.values()
 
+
+# Keeps a table of the devices of a service type. A single socket joins the
+# multicast group to receive NOTIFY ssdp:alive/byebye and the responses of
+# M-SEARCH, which is sent every search_interval seconds, or more often for
+# devices with a short max-age. on_event(event, response) is called with
+# 'alive', 'byebye' or 'expired' from the thread of the listener.
+class SSDPListener(threading.Thread):
+
+    def __init__(self, service, on_event, interfaces=None,
+                 search_interval=60.0):
+        super(SSDPListener, self).__init__()
+        self.service = service
+        self.on_event = on_event
+        self.interfaces = interfaces or ['0.0.0.0']
+        self.search_interval = search_interval
+        self.lock = threading.Lock()
+        self.in_service = True
+        self.daemon = True
+        # USN -> (SSDPResponse, expiration time)
+        self.devices = {}
+
+    def inactivate(self):
+        with self.lock:
+            self.in_service = False
+
+    def search(self):
+        message = get_search_message(self.service)
+        for interface in self.interfaces:
+            try:
+                self.sock.setsockopt(socket.IPPROTO_IP,
+                                     socket.IP_MULTICAST_IF,
+                                     socket.inet_aton(interface))
+                self.sock.sendto(message, SSDP_GROUP)
+            except socket.error as e:
+                logger.warning('M-SEARCH failed on %s: %s' % (interface, e))
+
+    def run(self):
+        self.sock = self._open_socket()
+        last_search = None
+        try:
+            while self._in_service():
+                now = time.time()
+                if last_search is None or \
+                   last_search + self.get_search_interval() <= now:
+                    self.search()
+                    last_search = now
+                readable, _, _ = select.select([self.sock], [], [], 1.0)
+                if readable:
+                    data, addr = self.sock.recvfrom(MAX_DATAGRAM_SIZE)
+                    self._on_datagram(data)
+                self._expire()
+        finally:
+            self.sock.close()
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                             socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+        try:
+            sock.bind(('', SSDP_GROUP[1]))
+            for interface in self.interfaces:
+                mreq = struct.pack('4s4s', socket.inet_aton(SSDP_GROUP[0]),
+                                   socket.inet_aton(interface))
+                sock.setsockopt(socket.IPPROTO_IP,
+                                socket.IP_ADD_MEMBERSHIP, mreq)
+        except socket.error as e:
+            # Another process owns the port; responses of M-SEARCH still
+            # arrive on an ephemeral port
+            logger.warning('Passive SSDP is not available: %s' % e)
+            sock.close()
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                 socket.IPPROTO_UDP)
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+            sock.bind(('', 0))
+        return sock
+
+    def _on_datagram(self, data):
+        if data.startswith('M-SEARCH'):
+            return
+        try:
+            response = SSDPResponse(data)
+        except (ValueError, IndexError):
+            return
+        if response.st != self.service or response.usn is None:
+            return
+        if response.nts == 'ssdp:byebye':
+            if response.usn in self.devices:
+                del self.devices[response.usn]
+            self.on_event('byebye', response)
+            return
+        if response.location is None:
+            return
+        known = self.devices.get(response.usn)
+        expires = time.time() + response.get_max_age()
+        self.devices[response.usn] = (response, expires)
+        if known is None or known[0].location != response.location:
+            self.on_event('alive', response)
+
+    def get_search_interval(self):
+        interval = self.search_interval
+        for response, expires in self.devices.values():
+            interval = min(interval, float(response.get_max_age()) /
+                           SEARCHES_PER_MAX_AGE)
+        return max(interval, MIN_SEARCH_INTERVAL)
+
+    def _expire(self):
+        now = time.time()
+        grace = EXPIRY_GRACE_SEARCHES * self.get_search_interval()
+        for usn, (response, expires) in self.devices.items():
+            if expires + grace <= now:
+                del self.devices[usn]
+                self.on_event('expired', response)
+
+    def _in_service(self):
+        with self.lock:
+            return self.in_service
+
 # Example:
 # import ssdp
-# ssdp.discover("roku:ecp")
\ No newline at end of file
+# ssdp.discover("roku:ecp")
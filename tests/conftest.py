@@ -0,0 +1,54 @@
+import json
+import os
+import sys
+import time
+
+import pytest
+
+# The adapters import each other as top-level modules, and grovepi and
+# applescript are only available on their own platforms
+base = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(base, '..', 'mqttadapters'))
+sys.path.insert(0, os.path.join(base, 'stubs'))
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload=None, **kwargs):
+        self.published.append((topic, json.loads(payload)))
+
+
+class Message(object):
+
+    def __init__(self, topic, payload):
+        # Payloads other than strings are encoded like the publishers do
+        self.topic = topic
+        if isinstance(payload, basestring):
+            self.payload = payload
+        else:
+            self.payload = json.dumps(payload)
+
+
+def poll_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def client():
+    return FakeClient()
+
+
+@pytest.fixture
+def message():
+    return Message
+
+
+@pytest.fixture
+def wait_for():
+    return poll_until
@@ -0,0 +1,11 @@
+# Runs Python functions instead of AppleScript handlers. Tests put functions
+# in AppleScript.handlers[handler name].
+class AppleScript(object):
+
+    handlers = {}
+
+    def __init__(self, source):
+        self.source = source
+
+    def call(self, name, *args):
+        return self.handlers[name](*args)
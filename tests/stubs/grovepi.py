@@ -0,0 +1,28 @@
+# Replays traces instead of reading the bus of a GrovePi. Tests put lists of
+# values in readings[(function name, port)].
+readings = {}
+modes = {}
+
+
+def _next(name, port):
+    return readings[(name, port)].pop(0)
+
+
+def pinMode(port, mode):
+    modes[port] = mode
+
+
+def analogRead(port):
+    return _next('analogRead', port)
+
+
+def digitalRead(port):
+    return _next('digitalRead', port)
+
+
+def ultrasonicRead(port):
+    return _next('ultrasonicRead', port)
+
+
+def dht(port, module_type):
+    return _next('dht', port)
@@ -0,0 +1,76 @@
+import threading
+import time
+
+from common import Dispatcher
+
+
+def test_dispatcher_runs_commands_of_a_key_in_order():
+    results = []
+    done = threading.Event()
+    dispatcher = Dispatcher(workers=2)
+    for i in range(10):
+        dispatcher.submit('a', results.append, i)
+    dispatcher.submit('a', done.set)
+    assert done.wait(5)
+    assert results == range(10)
+
+
+def test_dispatcher_reports_dropped_commands():
+    blocker = threading.Event()
+    dropped = []
+    dispatcher = Dispatcher(workers=1, queue_size=2,
+                            on_drop=lambda key, func, args:
+                            dropped.append((key, args)))
+    dispatcher.submit('busy', blocker.wait)
+    time.sleep(0.1)
+    dispatcher.submit('a', len, 'first')
+    dispatcher.submit('b', len, 'second')
+    dispatcher.submit('c', len, 'third')
+    blocker.set()
+    assert dropped == [('a', ('first',))]
+    assert dispatcher.stats()['dropped'] == 1
+
+
+def test_dispatcher_drop_new():
+    blocker = threading.Event()
+    dropped = []
+    dispatcher = Dispatcher(workers=1, queue_size=1, overflow='drop-new',
+                            on_drop=lambda key, func, args:
+                            dropped.append(key))
+    dispatcher.submit('busy', blocker.wait)
+    time.sleep(0.1)
+    assert dispatcher.submit('a', len, 'first')
+    assert not dispatcher.submit('b', len, 'second')
+    assert dispatcher.stats()['depth'] == 1
+    blocker.set()
+    assert dropped == ['b']
+
+
+def test_topic_router_lookup():
+    from common import TopicRouter
+    router = TopicRouter()
+    router.add('hue/a', 'a')
+    router.add('hue/a/light/1', 'a1')
+    router.add('hue/b', 'b')
+    assert router.lookup('hue/a/light/2/status') == ('a', ['light', '2',
+                                                           'status'])
+    assert router.lookup('hue/a/light/1/status') == ('a1', ['status'])
+    assert router.lookup('hue/a') == ('a', [])
+    assert router.lookup('hue/c/light/1') == (None, None)
+    assert router.get('hue/b') == 'b'
+    assert router.get('hue/b/light') is None
+
+
+def test_topic_router_remove():
+    from common import TopicRouter
+    router = TopicRouter()
+    router.add('hue/a', 'a')
+    router.add('hue/a/light/1', 'a1')
+    router.remove('hue/a/light/1')
+    assert router.lookup('hue/a/light/1/status') == ('a', ['light', '1',
+                                                           'status'])
+    router.remove('hue/a')
+    router.remove('hue/unknown')
+    assert router.lookup('hue/a') == (None, None)
+    assert router.root == {}
+    assert router.values() == []
@@ -0,0 +1,152 @@
+import json
+
+import pytest
+
+import grove
+import grovepi
+
+
+def test_sensors_of_the_same_type_have_their_own_topics(tmpdir, client):
+    config = tmpdir.join('sensors.json')
+    config.write(json.dumps([{'type': 'light', 'id': 'desk', 'light': 0},
+                             {'type': 'light', 'id': 'window', 'light': 1},
+                             {'type': 'pir', 'port': 8}]))
+    sensors = grove.load_sensors(str(config), 'pi', client)
+    assert [s._get_topic() for s in sensors] == \
+        ['grovepi/pi/desk', 'grovepi/pi/window', 'grovepi/pi/motion']
+
+    grovepi.readings[('analogRead', 0)] = [100]
+    grovepi.readings[('analogRead', 1)] = [900]
+    for sensor in sensors[:2]:
+        sensor.sample()
+    assert [(t, m['raw']) for t, m in client.published] == \
+        [('grovepi/pi/desk', 100.0), ('grovepi/pi/window', 900.0)]
+
+
+def test_duplicated_ids_are_rejected(tmpdir, client):
+    config = tmpdir.join('sensors.json')
+    config.write(json.dumps([{'type': 'light', 'light': 0},
+                             {'type': 'light', 'light': 1}]))
+    with pytest.raises(ValueError):
+        grove.load_sensors(str(config), 'pi', client)
+
+
+def test_history_wraps_around_and_survives_reopen(tmpdir):
+    path = str(tmpdir.join('light.history'))
+    history = grove.SampleHistory(4, path)
+    for i in range(6):
+        history.append(100.0 + i, i * 10)
+    assert history.query(0, 1e12) == \
+        [(102.0, 20.0), (103.0, 30.0), (104.0, 40.0), (105.0, 50.0)]
+    history.close()
+    history = grove.SampleHistory(4, path)
+    assert history.query(103, 105) == [(103.0, 30.0), (104.0, 40.0)]
+    history.close()
+
+
+def test_encode_history():
+    samples = [(100.0, 1.0), (100.5, 3.0), (103.0, 5.0)]
+    assert grove.encode_history(samples, 100.0) == \
+        {'start': 100.0, 'times': [0, 500, 2500], 'values': [1.0, 3.0, 5.0]}
+    assert grove.encode_history(samples, 90.0, 5.0) == \
+        {'start': 100.0, 'step': 5.0, 'mean': [3.0], 'min': [1.0],
+         'max': [5.0]}
+
+
+def test_invalid_history_requests_are_answered_with_errors(client,
+                                                           message):
+    grovepi.readings[('ultrasonicRead', 4)] = [10, 20]
+    sensor = grove.UltrasonicSensor('pi', client, 4)
+    sensor.sample()
+    sensor.sample()
+    sensors = grove.Sensors('pi', client, [sensor])
+    topic = 'grovepi/pi/ultrasonic/history'
+    for payload in ['{"step": 0}', '[]', '{"start": "a"}', 'x']:
+        sensors.on_message(client, None, message(topic, payload))
+    assert len(client.published) == 6
+    for t, response in client.published[2:]:
+        assert t == topic + '/result'
+        assert 'message' in response
+    sensors.on_message(client, None, message(topic, '{"start": 0, "id": 1}'))
+    assert client.published[-1][1]['values'] == [10, 20]
+    assert client.published[-1][1]['id'] == 1
+
+
+def test_sensors_of_the_same_type_have_their_own_history_files(
+        tmpdir, monkeypatch, client):
+    monkeypatch.setattr(grove, 'history_dir', str(tmpdir))
+    desk = grove.LightSensor('pi', client, 0, sensor_id='desk')
+    window = grove.LightSensor('pi', client, 1, sensor_id='window')
+    desk.history.append(1.0, 100)
+    window.history.append(1.0, 900)
+    assert desk.history.query(0, 2) == [(1.0, 100.0)]
+    assert window.history.query(0, 2) == [(1.0, 900.0)]
+    desk.history.close()
+    window.history.close()
+
+
+# Distances of the ultrasonic sensor with a single spike, as recorded on a
+# desk
+ULTRASONIC_TRACE = [30, 31, 30, 400, 30, 29, 31, 30, 30, 32, 31, 30]
+
+
+def test_median_filter():
+    f = grove.MedianFilter(3)
+    assert [f.put(v) for v in [30, 400, 31, 32, 5]] == \
+        [30, 400, 31, 32, 31]
+
+
+def test_ema_filter():
+    f = grove.EMAFilter(0.5)
+    assert [f.put(v) for v in [10, 20, 20]] == [10.0, 15.0, 17.5]
+
+
+def test_window_aggregates():
+    pipeline = grove.Pipeline(window=1.0, deadband=0)
+    assert pipeline.put(10, 100.0) is None
+    assert pipeline.put(20, 100.5) is None
+    assert pipeline.put(30, 101.0) == \
+        {'min': 10, 'max': 30, 'mean': 20.0, 'count': 3}
+    assert pipeline.put(40, 101.2) is None
+    assert pipeline.put(40, 102.2) == \
+        {'min': 40, 'max': 40, 'mean': 40.0, 'count': 2}
+
+
+def test_deadband():
+    pipeline = grove.Pipeline(deadband=5)
+    published = [pipeline.put(v, 100.0 + i)
+                 for i, v in enumerate([10, 12, 14, 16, 16])]
+    assert [p['mean'] if p else None for p in published] == \
+        [10.0, None, None, 16.0, None]
+    # Published anyway after MAX_INTERVAL
+    assert pipeline.put(16, 103.0 + grove.MAX_INTERVAL)['mean'] == 16.0
+
+
+def replay(client, trace, **options):
+    grovepi.readings[('ultrasonicRead', 4)] = list(trace)
+    sensor = grove.UltrasonicSensor('pi', client, 4, **options)
+    for i in range(len(trace)):
+        sensor.sample()
+    return [m['distant'] for t, m in client.published]
+
+
+def test_spike_is_published_without_filter(client):
+    assert replay(client, ULTRASONIC_TRACE) == [30.0, 400.0, 30.0]
+
+
+def test_spike_is_removed_by_median_filter(client):
+    assert replay(client, ULTRASONIC_TRACE, filter='median', filter_size=3,
+                  deadband=3) == [30.0]
+
+
+def test_unknown_filter():
+    with pytest.raises(ValueError):
+        grove.Pipeline(filter='mean')
+
+
+def test_history_dir_is_created(tmpdir, monkeypatch, client):
+    monkeypatch.setattr(grove, 'history_dir', str(tmpdir.join('a', 'b')))
+    sensor = grove.LightSensor('pi', client, 0, sensor_id='desk')
+    sensor.history.append(1.0, 100)
+    sensor.history.close()
+    assert tmpdir.join('a', 'b', 'desk.history').check()
@@ -0,0 +1,348 @@
+import time
+
+import hue
+from common import DeviceCache
+
+
+class FakeListener(object):
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def start(self):
+        pass
+
+    def inactivate(self):
+        pass
+
+
+class FakeBridge(object):
+
+    def __init__(self, mqtt_client, device, **kwargs):
+        self.device = device
+
+    def start(self):
+        pass
+
+    def inactivate(self):
+        pass
+
+
+class FakeResponse(object):
+
+    location = 'http://192.168.0.2:80/description.xml'
+    usn = 'uuid:2f402f80-da50-11e1-9b23-001788102201::upnp:rootdevice'
+
+    def get_max_age(self):
+        return 100
+
+
+def get_device():
+    return hue.DeviceInfo.from_cache({
+        'model_name': 'Philips hue bridge 2015',
+        'udn': 'uuid:2f402f80-da50-11e1-9b23-001788102201',
+        'urlbase': 'http://192.168.0.2:80/'})
+
+
+def test_failed_description_is_fetched_again(monkeypatch, client, wait_for):
+    monkeypatch.setattr(hue.ssdp, 'SSDPListener', FakeListener)
+    monkeypatch.setattr(hue, 'HueBridge', FakeBridge)
+    monkeypatch.setattr(hue, 'DESCRIPTION_RETRY_SEC', 0.1)
+    results = [None, get_device()]
+    fetched = []
+
+    def fetch(target):
+        fetched.append(target.location)
+        return results.pop(0)
+
+    browser = hue.DeviceBrowser(client, interval=0.05,
+                                cache=DeviceCache(None))
+    monkeypatch.setattr(browser, 'devices', {})
+    monkeypatch.setattr(browser, '_fetch_description', fetch)
+    browser.start()
+    try:
+        # The listener announces a location only once
+        browser.on_ssdp('alive', FakeResponse())
+        assert wait_for(lambda: get_device().udn in browser.devices)
+        assert len(fetched) == 2
+    finally:
+        browser.inactivate()
+
+
+class FakePhueBridge(object):
+
+    failures = 0
+    gets = 0
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.username = 'user'
+
+    def connect(self):
+        if FakePhueBridge.failures > 0:
+            FakePhueBridge.failures -= 1
+            raise IOError('unreachable')
+
+    def get_api(self):
+        return {}
+
+    def get_light(self):
+        FakePhueBridge.gets += 1
+        return {'1': {'name': 'Desk', 'state': {'on': True, 'bri': 10,
+                                                'hue': 0, 'sat': 0}}}
+
+
+def test_bridge_connect_is_retried(monkeypatch, client, wait_for):
+    monkeypatch.setattr(hue, 'Bridge', FakePhueBridge)
+    monkeypatch.setattr(hue, 'CONNECT_RETRY_MIN_SEC', 0.01)
+    monkeypatch.setattr(FakePhueBridge, 'failures', 3)
+    monkeypatch.setattr(FakePhueBridge, 'gets', 0)
+    bridge = hue.HueBridge(client, get_device(), use_eventstream=False)
+    bridge.start()
+    try:
+        assert wait_for(lambda: FakePhueBridge.gets > 0)
+        assert FakePhueBridge.failures == 0
+        assert bridge.is_alive()
+    finally:
+        bridge.inactivate()
+        bridge.actions.wake()
+        bridge.join(5)
+
+
+class RejectingBridge(object):
+
+    def set_light(self, light_id, params):
+        return [[{'error': {'type': 201, 'description': 'device is off'}}]]
+
+
+def test_rejected_writes_are_failures(client):
+    bridge = hue.HueBridge(client, get_device(), use_eventstream=False)
+    lights = {'1': {'name': 'Desk', 'last_status': None}}
+    actions = {('light', '1'): {'status': {'brightness': 100},
+                                'time': time.time()}}
+    bridge._apply_actions(RejectingBridge(), lights, actions)
+    assert bridge.stats['sent'] == 0
+    assert bridge.stats['errors'] == 1
+    assert lights['1']['last_status'] is None
+    assert bridge.bucket.get_wait() > 0
+
+
+def test_get_errors():
+    assert hue.get_errors([{'success': {'/lights/1/state/on': True}}]) == []
+    assert hue.get_errors([[{'error': {'type': 1}}], []]) == [{'type': 1}]
+
+
+def test_silent_event_stream_is_connected_again(monkeypatch, wait_for):
+    import socket
+    import threading
+    monkeypatch.setattr(hue, 'EVENTSTREAM_READ_TIMEOUT_SEC', 0.2)
+    monkeypatch.setattr(hue, 'EVENTSTREAM_RETRY_SEC', 0.05)
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    accepted = []
+
+    def serve():
+        # Sends the headers, and then nothing like a half-open connection
+        while len(accepted) < 2:
+            conn, addr = server.accept()
+            conn.recv(4096)
+            conn.sendall('HTTP/1.1 200 OK\r\n'
+                         'Content-Type: text/event-stream\r\n\r\n')
+            accepted.append(conn)
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    stream = hue.EventStream('127.0.0.1', 'user', lambda ids: None)
+    stream.url = 'http://127.0.0.1:%d/eventstream/clip/v2' % \
+        server.getsockname()[1]
+    stream.start()
+    try:
+        assert wait_for(lambda: len(accepted) >= 2)
+    finally:
+        stream.inactivate()
+        for conn in accepted:
+            conn.close()
+        server.close()
+
+
+class CountingBridge(object):
+
+    def __init__(self, count):
+        self.requests = 0
+        self.lights = dict([(str(i), {'name': 'Light %d' % i,
+                                      'state': {'on': True, 'bri': i,
+                                                'hue': 0, 'sat': 0}})
+                            for i in range(1, count + 1)])
+
+    def get_light(self, light_id=None, parameter=None):
+        self.requests += 1
+        if light_id is not None:
+            return self.lights[str(light_id)]
+        return self.lights
+
+
+def test_poll_makes_one_request_for_any_number_of_lights(client):
+    for count in [1, 10, 100]:
+        del client.published[:]
+        bridge = hue.HueBridge(client, get_device(), use_eventstream=False)
+        b = CountingBridge(count)
+        lights = {}
+        bridge._poll_lights(b, lights)
+        assert b.requests == 1
+        assert len([p for t, p in client.published
+                    if p.get('action') == 'added']) == count
+        assert len([t for t, p in client.published
+                    if t.endswith('/status')]) == count
+
+        # Only changes are published in the next cycles
+        del client.published[:]
+        b.lights['1']['state']['on'] = False
+        del b.lights[str(count)]
+        bridge._poll_lights(b, lights)
+        assert b.requests == 2
+        statuses = [(t, p) for t, p in client.published
+                    if t.endswith('/status')]
+        removed = [p for t, p in client.published
+                   if p.get('action') == 'removed']
+        assert len(removed) == 1
+        assert len(statuses) == (1 if count > 1 else 0)
+
+
+def test_status_which_is_not_an_object_is_an_error(client, message):
+    changes = []
+    browser = hue.DeviceBrowser(client, cache=DeviceCache(None))
+    bridge = FakeBridge(client, get_device())
+    bridge.change = lambda light_id, status: changes.append((light_id,
+                                                             status))
+    browser.router.add(hue.get_topic(get_device().udn), {'bridge': bridge})
+    topic = hue.get_light_topic(get_device().udn, '1') + '/status'
+    for payload in ['5', 'null', 'true', '"on"']:
+        browser.on_message(client, None, message(topic, payload))
+    assert [t for t, p in client.published] == ['hue/error'] * 4
+    browser.on_message(client, None, message(topic, {'on': True}))
+    assert changes == [('1', {'on': True})]
+
+
+class RecordingBridge(object):
+
+    def __init__(self, create_result=None):
+        self.calls = []
+        self.groups = {}
+        self.create_result = create_result
+
+    def set_light(self, light_id, params):
+        self.calls.append(('light', light_id, params))
+        return [{'success': {}}]
+
+    def set_group(self, group_id, params):
+        self.calls.append(('group', group_id, params))
+        return [{'success': {}}]
+
+    def get_group(self):
+        return self.groups
+
+    def create_group(self, name, lights):
+        self.calls.append(('create', lights))
+        if self.create_result is not None:
+            return self.create_result
+        group_id = str(len(self.groups) + 1)
+        self.groups[group_id] = {'name': name, 'lights': lights}
+        return [{'success': {'id': group_id}}]
+
+
+def get_lights(count):
+    return dict([(str(i), {'name': 'Light %d' % i, 'last_status': None})
+                 for i in range(1, count + 1)])
+
+
+def test_pending_commands_are_merged_into_one_write(client):
+    bridge = hue.HueBridge(client, get_device(), use_eventstream=False)
+    bridge.change('1', {'brightness': 100})
+    bridge.change('1', {'hue': 200})
+    bridge.change('1', {'brightness': 150})
+    b = RecordingBridge()
+    bridge._apply_actions(b, get_lights(1), bridge.actions.take_all(0))
+    assert b.calls == [('light', 1, {'bri': 150, 'hue': 200})]
+
+
+def test_identical_commands_are_fanned_out_as_a_group(client):
+    bridge = hue.HueBridge(client, get_device(), use_eventstream=False)
+    b = RecordingBridge()
+    for i in range(2):
+        for light_id in ['1', '2', '3']:
+            bridge.change(light_id, {'brightness': 100 + i})
+        bridge.change('4', {'brightness': 50})
+        bridge._apply_actions(b, get_lights(4), bridge.actions.take_all(0))
+    # The group created for the first command is used again
+    assert sorted(b.calls) == sorted([
+        ('create', ['1', '2', '3']), ('group', 1, {'bri': 100}),
+        ('light', 4, {'bri': 50}), ('group', 1, {'bri': 101}),
+        ('light', 4, {'bri': 50})])
+    assert bridge.stats['sent'] == 4
+
+
+def test_lights_are_changed_one_by_one_if_no_group_is_created(client):
+    bridge = hue.HueBridge(client, get_device(), use_eventstream=False)
+    b = RecordingBridge(create_result=[{'error': {
+        'type': 301, 'description': 'group table full'}}])
+    lights = get_lights(3)
+    for i in range(2):
+        for light_id in ['1', '2', '3']:
+            bridge.change(light_id, {'brightness': 100 + i})
+        bridge._apply_actions(b, lights, bridge.actions.take_all(0))
+    # Creating a group is not retried for a while
+    assert b.calls == [('create', ['1', '2', '3'])] + \
+        [('light', i, {'bri': 100}) for i in [1, 2, 3]] + \
+        [('light', i, {'bri': 101}) for i in [1, 2, 3]]
+    assert bridge.stats['errors'] == 0
+    assert lights['3']['last_status'] == {'brightness': 101}
+
+
+def test_on_and_off_are_sent_first(client):
+    bridge = hue.HueBridge(client, get_device(), use_eventstream=False)
+    bridge.change('1', {'brightness': 100})
+    time.sleep(0.01)
+    bridge.change('2', {'on': False})
+    b = RecordingBridge()
+    bridge._apply_actions(b, get_lights(2), bridge.actions.take_all(0))
+    assert b.calls == [('light', 2, {'on': False}),
+                       ('light', 1, {'bri': 100})]
+
+
+def test_stale_commands_are_dropped(client):
+    bridge = hue.HueBridge(client, get_device(), use_eventstream=False,
+                           max_age=1.0)
+    b = RecordingBridge()
+    actions = {('light', '1'): {'status': {'brightness': 100},
+                                'time': time.time() - 2.0},
+               ('light', '2'): {'status': {'brightness': 100},
+                                'time': time.time()}}
+    bridge._apply_actions(b, get_lights(2), actions)
+    assert b.calls == [('light', 2, {'bri': 100})]
+    assert bridge.stats['dropped'] == 1
+
+
+def test_refused_event_stream_backs_off(monkeypatch, caplog, wait_for):
+    import logging
+    monkeypatch.setattr(hue, 'EVENTSTREAM_RETRY_SEC', 0.02)
+    monkeypatch.setattr(hue, 'EVENTSTREAM_RETRY_MAX_SEC', 0.16)
+    attempts = []
+
+    def refuse():
+        attempts.append(time.time())
+        raise IOError('Connection refused')
+
+    stream = hue.EventStream('127.0.0.1', 'user', lambda ids: None)
+    stream._consume = refuse
+    stream.start()
+    try:
+        assert wait_for(lambda: len(attempts) >= 6)
+    finally:
+        stream.inactivate()
+    gaps = [b - a for a, b in zip(attempts, attempts[1:])]
+    assert gaps[0] < 0.1
+    assert gaps[4] >= 0.15
+    warnings = [r for r in caplog.records if r.levelno == logging.WARNING]
+    assert len(warnings) == 1
@@ -0,0 +1,168 @@
+import json
+import random
+import threading
+import time
+
+import pytest
+
+import irkit
+
+
+def get_signal(seed, length=400):
+    rand = random.Random(seed)
+    return {'format': 'raw', 'freq': 38,
+            'data': [rand.randint(100, 20000) for i in range(length)]}
+
+
+def test_echo_is_suppressed_once():
+    cache = irkit.EchoCache(4)
+    cache.put(get_signal(1))
+    assert cache.has(get_signal(1))
+    assert not cache.has(get_signal(1))
+    assert not cache.has(get_signal(2))
+
+
+def test_echo_key_ignores_encoding():
+    signal = get_signal(1)
+    cache = irkit.EchoCache(4)
+    cache.put(signal)
+    assert cache.has({'format': 'raw', 'freq': 38, 'd': signal['data']})
+    assert irkit.get_signal_key(signal) != \
+        irkit.get_signal_key(dict(signal, freq=40))
+
+
+def test_echo_cache_is_bounded():
+    cache = irkit.EchoCache(3)
+    for i in range(10):
+        cache.put(get_signal(i))
+    assert len(cache.items) == 3
+    assert not cache.has(get_signal(0))
+    assert cache.has(get_signal(9))
+
+
+def test_echo_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(irkit.time, 'time', lambda: now[0])
+    cache = irkit.EchoCache(4, ttl=10.0)
+    cache.put(get_signal(1))
+    now[0] += 11.0
+    assert not cache.has(get_signal(1))
+    assert len(cache.items) == 0
+
+
+def test_echo_caches_are_per_host():
+    first = irkit.EchoCache(4)
+    second = irkit.EchoCache(4)
+    first.put(get_signal(1))
+    assert not second.has(get_signal(1))
+    assert first.has(get_signal(1))
+
+
+def test_compact_encoding_round_trip():
+    for data in [[], [0], [9000, 4500, 560, 1690, 560, 560],
+                 get_signal(3, 1000)['data'], [5, -5, 300000, 0]]:
+        assert irkit.decode_data(irkit.encode_data(data)) == data
+
+
+def test_compact_encoding_is_smaller():
+    # NEC frame as received by an IRKit
+    data = [18031, 8755] + [1190, 1190, 1190, 3341] * 32 + [1190, 65535]
+    assert len(irkit.encode_data(data)) < len(','.join(map(str, data))) / 2
+
+
+class EmptyResponse(object):
+
+    status_code = 200
+    content = ''
+
+    def raise_for_status(self):
+        pass
+
+
+def test_threads_do_not_grow_with_hosts(monkeypatch, client, wait_for):
+    polls = {}
+
+    def poll(host):
+        polls[host.name] = polls.get(host.name, 0) + 1
+        return EmptyResponse()
+
+    monkeypatch.setattr(irkit.IRKitHost, '_poll', poll)
+    poller = irkit.PollScheduler()
+    poller.start()
+    library = irkit.SignalLibrary(None)
+    hosts = []
+    finished = set()
+
+    def add_hosts(start, count):
+        for i in range(start, start + count):
+            host = irkit.IRKitHost('irkit%d' % i, u'10.0.%d.%d' %
+                                   (i / 250, i % 250 + 1), 80, client,
+                                   library, poller, poll_floor=0.05,
+                                   poll_ceiling=0.1)
+            host.on_finished = finished.add
+            hosts.append(host)
+            host.start()
+
+    add_hosts(0, 10)
+    assert wait_for(lambda: len(polls) == 10)
+    threads = threading.active_count()
+    add_hosts(10, 490)
+    assert wait_for(lambda: len(polls) == 500)
+    assert threading.active_count() <= threads
+    # Every host keeps being polled
+    counts = dict(polls)
+    assert wait_for(lambda: all([polls[n] > counts[n] for n in counts]))
+
+    monkeypatch.setattr(irkit, 'SERVICE_TIMEOUT', 0)
+    for host in hosts:
+        host.inactivate()
+    assert wait_for(lambda: len(finished) == 500)
+
+
+class FakeHost(object):
+
+    name = 'irkit1'
+
+
+def test_requests_which_are_not_objects_are_errors(client, message):
+    learned = []
+    listener = irkit.HostListener(client, cache=None)
+    host = FakeHost()
+    host.learn = learned.append
+    listener.router.add(irkit.get_learn_topic('irkit1'), host)
+    for topic in [irkit.get_learn_topic('irkit1'),
+                  irkit.get_messages_topic('irkit1')]:
+        for payload in ['"tv_power"', 'null', '1']:
+            listener.on_message(client, None, message(topic, payload))
+    assert [t for t, p in client.published] == ['irkit/error'] * 6
+    listener.on_message(client, None,
+                        message(irkit.get_learn_topic('irkit1'),
+                                {'name': 'tv_power'}))
+    assert learned == ['tv_power']
+
+
+def test_poll_settings_are_per_host(monkeypatch, client, tmpdir):
+    monkeypatch.setattr(irkit.IRKitHost, 'start', lambda self: None)
+    monkeypatch.setattr(irkit.HostListener, 'hosts', {})
+    settings = tmpdir.join('poll.json')
+    settings.write(json.dumps({'IRKitD2A4': {'poll_floor': 0.5,
+                                             'poll_ceiling': 30}}))
+    listener = irkit.HostListener(
+        client, poll_settings=irkit.load_poll_settings(str(settings)),
+        poll_floor=0.2, poll_ceiling=10.0)
+    tuned = listener._add_host(u'IRKitD2A4._irkit._tcp.local.',
+                               u'10.0.0.2', 80)
+    default = listener._add_host(u'IRKit1234._irkit._tcp.local.',
+                                 u'10.0.0.3', 80)
+    assert (tuned.poll_floor, tuned.poll_ceiling) == (0.5, 30)
+    assert (default.poll_floor, default.poll_ceiling) == (0.2, 10.0)
+
+
+def test_invalid_poll_settings(tmpdir):
+    settings = tmpdir.join('poll.json')
+    for invalid in [{'IRKitD2A4': {'poll_floor': 0}},
+                    {'IRKitD2A4': {'poll_interval': 1}},
+                    {'IRKitD2A4': 1}]:
+        settings.write(json.dumps(invalid))
+        with pytest.raises(ValueError):
+            irkit.load_poll_settings(str(settings))
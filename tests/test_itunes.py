@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import random
+import threading
+import time
+
+import itunes
+
+WORDS = [u'Love', u'Night', u'Blue', u'Sky', u'Dream', u'Heart', u'Fire',
+         u'Rain', u'Moon', u'夜']
+
+
+def get_library(size):
+    rand = random.Random(1)
+    return {'playlist_name': u'Music', 'track_ids': range(size),
+            'track_names': [u' '.join(rand.sample(WORDS, 3)) + u' %d' % i
+                            for i in range(size)],
+            'track_artists': [u'Artist %d' % (i % 500) for i in range(size)],
+            'track_albums': [u'Album %d' % (i % 5000) for i in range(size)],
+            'modified': [0] * size}
+
+
+def scan(library, **fields):
+    # What the filter() passes over the AppleScript search results returned
+    results = []
+    for i in range(len(library['track_ids'])):
+        track = {'track_name': library['track_names'][i],
+                 'track_artist': library['track_artists'][i],
+                 'track_album': library['track_albums'][i]}
+        if all([v in track[k] for k, v in fields.items()]):
+            results.append(track)
+    return results
+
+
+def names(results):
+    return [r['track_name'] for r in results]
+
+
+def test_find_matches_substrings_case_sensitively():
+    library = get_library(1000)
+    index = itunes.LibraryIndex()
+    index.load(library)
+    for query in [{'track_album': u'Album 42'},
+                  {'track_artist': u'rtist 12'},
+                  {'track_artist': u'Artist 4', 'track_name': u'ky Dre'},
+                  {'track_album': u'album 42'},
+                  {'track_album': u'um 1', 'track_name': u'夜'},
+                  {'track_album': u'Album 7', 'track_name': u'Fire H'}]:
+        assert names(index.find(query)) == names(scan(library, **query))
+
+
+def test_find_in_playlists():
+    library = get_library(100)
+    index = itunes.LibraryIndex()
+    index.load(library)
+    # 1000 is not in the Music playlist
+    index.set_playlists([{'playlist_name': u'Fav',
+                          'track_ids': [3, 1, 1000]}])
+    results = index.find({'playlist_name': u'Fav'})
+    assert [r['playlist_name'] for r in results] == [u'Fav', u'Fav']
+    assert names(results) == [library['track_names'][1],
+                              library['track_names'][3]]
+    assert index.find({'playlist_name': u'Fav', 'track_name': u'999'}) == []
+    assert index.find({'playlist_name': u'Unknown',
+                       'track_name': u'Love'}) == []
+
+
+def test_incremental_updates():
+    index = itunes.LibraryIndex()
+    index.load(get_library(10))
+    revision = {'track_ids': range(1, 11), 'modified': [0] * 8 + [1, 0]}
+    changed, removed = index.get_changes(revision)
+    assert changed == [9, 10]
+    assert removed == set([0])
+    index.put([{'track_id': 9, 'track_name': u'Renamed',
+                'track_artist': u'Artist 9', 'track_album': u'Album 9',
+                'modified': 1},
+               {'track_id': 10, 'track_name': u'New',
+                'track_artist': u'Artist 9', 'track_album': u'Album 9',
+                'modified': 0}])
+    index.remove(removed)
+    assert index.get_changes(revision) == ([], set())
+    assert names(index.find({'track_artist': u'Artist 9'})) == \
+        [u'Renamed', u'New']
+    assert index.find({'track_artist': u'Artist 0'}) == []
+
+
+def test_large_library():
+    library = get_library(100000)
+    index = itunes.LibraryIndex()
+    index.load(library)
+    started = time.time()
+    results = index.find({'track_album': u'Album 42',
+                          'track_artist': u'Artist 42'})
+    found = time.time() - started
+    assert len(results) == 220
+    assert names(results) == names(scan(library, track_album=u'Album 42',
+                                        track_artist=u'Artist 42'))
+    assert found < 1.0
+
+
+def install_handlers(monkeypatch, calls, state):
+    library = {'playlist_name': u'Music', 'track_ids': [1],
+               'track_names': [u'Song'], 'track_artists': [u'Artist'],
+               'track_albums': [u'Album'], 'modified': [0]}
+
+    def apply_action(*args):
+        calls.append(args)
+        return dict(state)
+
+    monkeypatch.setattr(itunes.script, 'handlers', {
+        'export_library': lambda: library,
+        'export_playlists': lambda: [],
+        'apply_action': apply_action})
+
+
+def test_actions_and_polls_are_one_call(monkeypatch, client, message,
+                                        wait_for):
+    calls = []
+    state = {'state': 'paused'}
+    install_handlers(monkeypatch, calls, state)
+    browser = itunes.LibraryBrowser('x', client, interval=0.05)
+    browser.start()
+    try:
+        assert wait_for(lambda: calls)
+        browser.on_message(client, None, message(
+            'itunes/x/current', {'state': 'playing', 'track_artist': u'Artist'}))
+        assert wait_for(lambda: [c for c in calls if c[0] == 'play'])
+        state['state'] = 'playing'
+        assert wait_for(lambda: ('itunes/x/current', state)
+                        in client.published)
+        browser.on_message(client, None, message('itunes/x/current',
+                                                 {'state': 'paused'}))
+        assert wait_for(lambda: [c for c in calls if c[0] == 'pause'])
+    finally:
+        browser.inactivate()
+        browser.join(5)
+    assert [c for c in calls if c[0]] == \
+        [('play', u'Song', u'Artist', u'Album', u'Music'),
+         ('pause', '', '', '', '')]
+    assert set([c for c in calls if not c[0]]) == set([('', '', '', '', '')])
+
+
+def test_idle_polls_back_off(monkeypatch, client):
+    calls = []
+    install_handlers(monkeypatch, calls, {'state': 'paused'})
+    monkeypatch.setattr(itunes, 'IDLE_POLLS_BEFORE_BACKOFF', 3)
+    browser = itunes.LibraryBrowser('x', client, interval=0.02,
+                                    max_interval=0.2)
+    browser.start()
+    time.sleep(1.0)
+    browser.inactivate()
+    browser.join(5)
+    # 50 polls without the backoff
+    assert 5 < len(calls) < 20
+
+
+def test_script_calls_are_measured(monkeypatch, client):
+    monkeypatch.setattr(itunes.script, 'handlers', {
+        'current_state': lambda: time.sleep(0.01) or {'state': 'stopped'}})
+    browser = itunes.LibraryBrowser('x', client)
+    for i in range(3):
+        assert browser._call('current_state') == {'state': 'stopped'}
+    browser._publish_stats()
+    topic, stats = client.published[-1]
+    assert topic == 'itunes/x/stats'
+    assert stats['current_state']['count'] == 3
+    assert 0.01 <= stats['current_state']['avg'] <= \
+        stats['current_state']['max']
+    browser._publish_stats()
+    assert client.published[-1][1] == {}
+
+
+def test_library_refresh_does_not_block_actions(monkeypatch, client,
+                                                wait_for):
+    calls = []
+    install_handlers(monkeypatch, calls, {'state': 'paused'})
+    exporting = threading.Event()
+    exported = threading.Event()
+
+    def export_library():
+        exporting.set()
+        exported.wait(5)
+        return {'playlist_name': u'Music', 'track_ids': [], 'track_names': [],
+                'track_artists': [], 'track_albums': [], 'modified': []}
+
+    itunes.script.handlers['export_library'] = export_library
+    browser = itunes.LibraryBrowser('x', client, interval=0.02)
+    browser.start()
+    try:
+        assert exporting.wait(5)
+        assert wait_for(lambda: len(calls) >= 3)
+        assert not browser.library.loaded
+    finally:
+        exported.set()
+        browser.inactivate()
+        browser.join(5)
+    assert wait_for(lambda: browser.library.loaded)
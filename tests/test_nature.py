@@ -0,0 +1,222 @@
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import pytest
+
+import nature
+from common import Dispatcher
+
+
+def test_dropped_command_does_not_block_the_topic(monkeypatch, client,
+                                                  message):
+    sent = []
+    blocker = threading.Event()
+    monkeypatch.setattr(nature, 'nature_post',
+                        lambda client, topic, command:
+                        sent.append((topic, command)))
+    monkeypatch.setattr(nature, 'pending', {})
+    monkeypatch.setattr(nature, 'dispatcher', Dispatcher(
+        workers=1, queue_size=1,
+        on_drop=lambda topic, func, args: nature.nature_on_drop(
+            client, topic, func, args)))
+    nature.dispatcher.submit('busy', blocker.wait)
+    time.sleep(0.1)
+
+    nature.nature_on_message(client, None,
+                             message('nature/tv/light', {'button': 'on'}))
+    # Evicts the job of nature/tv/light
+    nature.nature_on_message(client, None,
+                             message('nature/fan/light', {'button': 'on'}))
+    assert 'nature/tv/light' not in nature.pending
+    assert client.published[0][0] == 'nature/error'
+    assert client.published[0][1]['command'] == {'button': 'on'}
+
+    blocker.set()
+    time.sleep(0.1)
+    nature.nature_on_message(client, None,
+                             message('nature/tv/light', {'button': 'off'}))
+    time.sleep(0.1)
+    assert sent == [('nature/fan/light', {'button': 'on'}),
+                    ('nature/tv/light', {'button': 'off'})]
+
+
+def post_all(monkeypatch, client, message, topic, buttons):
+    sent = []
+    blocker = threading.Event()
+    monkeypatch.setattr(nature, 'nature_post',
+                        lambda client, topic, command:
+                        sent.append(command['button']))
+    monkeypatch.setattr(nature, 'pending', {})
+    monkeypatch.setattr(nature, 'dispatcher', Dispatcher(workers=1))
+    # Commands arrive while the first one is being sent
+    nature.dispatcher.submit(topic, blocker.wait)
+    for button in buttons:
+        nature.nature_on_message(client, None,
+                                 message(topic, {'button': button}))
+    done = threading.Event()
+    nature.dispatcher.submit(topic, done.set)
+    blocker.set()
+    assert done.wait(5)
+    return sent
+
+
+def test_repeated_absolute_buttons_are_coalesced(monkeypatch, client,
+                                                 message):
+    assert post_all(monkeypatch, client, message, 'nature/tv/light',
+                    ['on', 'on', 'on', 'off', 'off', 'on']) == \
+        ['on', 'off', 'on']
+
+
+def test_relative_buttons_are_sent_in_order(monkeypatch, client, message):
+    assert post_all(monkeypatch, client, message, 'nature/tv/light',
+                    ['bright-up', 'bright-up', 'bright-up', 'onoff',
+                     'onoff', 'night', 'night']) == \
+        ['bright-up', 'bright-up', 'bright-up', 'onoff', 'onoff', 'night']
+
+
+def test_command_which_is_not_an_object_is_an_error(monkeypatch, client,
+                                                    message):
+    monkeypatch.setattr(nature, 'pending', {})
+    for payload in ['"on"', 'null', '1']:
+        nature.nature_on_message(client, None,
+                                 message('nature/tv/light', payload))
+    assert [t for t, p in client.published] == ['nature/error'] * 3
+    assert nature.pending == {}
+
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+
+    # (status code, headers) of the next responses, 200 when empty
+    responses = []
+    paths = []
+
+    def do_GET(self):
+        FakeAPIHandler.paths.append(self.path)
+        status, headers = FakeAPIHandler.responses.pop(0) \
+            if FakeAPIHandler.responses else (200, {})
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('[]')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeAPIServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+@pytest.fixture
+def api(monkeypatch):
+    monkeypatch.setattr(FakeAPIHandler, 'responses', [])
+    monkeypatch.setattr(FakeAPIHandler, 'paths', [])
+    server = FakeAPIServer(('127.0.0.1', 0), FakeAPIHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def rate_limit(remaining, reset):
+    return {'X-Rate-Limit-Limit': '30', 'X-Rate-Limit-Remaining':
+            str(remaining), 'X-Rate-Limit-Reset': str(reset)}
+
+
+def test_rate_limit_headers_are_tracked(api):
+    reset = time.time() + 300
+    FakeAPIHandler.responses.append((200, rate_limit(25, reset)))
+    limiter = nature.RateLimiter()
+    assert limiter.request('GET', api + '/1/appliances').status_code == 200
+    assert limiter.remaining == 25
+    assert abs(limiter.reset - reset) < 0.01
+
+
+def test_rate_limited_request_is_retried_after(api):
+    FakeAPIHandler.responses.append((429, {'Retry-After': '0.3'}))
+    limiter = nature.RateLimiter()
+    started = time.time()
+    assert limiter.request('GET', api + '/1/appliances').status_code == 200
+    assert time.time() - started >= 0.3
+    assert len(FakeAPIHandler.paths) == 2
+
+
+def test_background_requests_leave_a_reserve(api, monkeypatch):
+    monkeypatch.setattr(nature, 'BACKGROUND_RESERVE', 2)
+    FakeAPIHandler.responses.append((200, rate_limit(3,
+                                                     time.time() + 0.5)))
+    limiter = nature.RateLimiter()
+    limiter.request('GET', api + '/first')
+    started = time.time()
+    limiter.request('GET', api + '/interactive')
+    assert time.time() - started < 0.3
+    limiter.request('GET', api + '/background', priority=nature.BACKGROUND)
+    assert time.time() - started >= 0.3
+
+
+class RecordingLimiter(nature.RateLimiter):
+
+    def __init__(self):
+        nature.RateLimiter.__init__(self)
+        self.granted = []
+
+    def _get_wait(self, priority):
+        # Called with the lock held, so the order is the order of the grants
+        wait = nature.RateLimiter._get_wait(self, priority)
+        if wait <= 0:
+            self.granted.append(priority)
+        return wait
+
+
+def test_interactive_requests_go_first(api):
+    FakeAPIHandler.responses.append((200, rate_limit(0, time.time() + 0.5)))
+    limiter = RecordingLimiter()
+    limiter.request('GET', api + '/first')
+    background = threading.Thread(
+        target=limiter.request, args=('GET', api + '/background'),
+        kwargs={'priority': nature.BACKGROUND})
+    background.start()
+    time.sleep(0.1)
+    interactive = threading.Thread(target=limiter.request,
+                                   args=('GET', api + '/interactive'))
+    interactive.start()
+    background.join(5)
+    interactive.join(5)
+    assert limiter.granted == [nature.INTERACTIVE, nature.INTERACTIVE,
+                               nature.BACKGROUND]
+    assert sorted(FakeAPIHandler.paths) == \
+        ['/background', '/first', '/interactive']
+
+
+class BlockingZeroconf(object):
+
+    def __init__(self):
+        self.resolving = threading.Event()
+
+    def get_service_info(self, type, name):
+        self.resolving.wait(5)
+
+        class Info(object):
+            address = '\x0a\x00\x00\x02'
+            port = 80
+        return Info()
+
+
+def test_remo_is_resolved_off_the_zeroconf_thread(wait_for):
+    remos = nature.RemoListener(Dispatcher())
+    zeroconf = BlockingZeroconf()
+    started = time.time()
+    remos.add_service(zeroconf, nature.REMO_SERVICE_TYPE,
+                      'Remo-A1B2C3._remo._tcp.local.')
+    assert time.time() - started < 0.5
+    assert remos.get_host({'mac_address': '00:11:22:a1:b2:c3'}) is None
+    zeroconf.resolving.set()
+    assert wait_for(lambda: remos.get_host(
+        {'mac_address': '00:11:22:a1:b2:c3'}) == '10.0.0.2:80')
@@ -0,0 +1,87 @@
+import socket
+import time
+
+import ssdp
+
+SERVICE = 'urn:schemas-upnp-org:device:basic:1'
+USN = 'uuid:2f402f80-da50-11e1-9b23-001788102201::' + SERVICE
+
+
+def get_notify(nts, location='http://192.168.0.2:80/description.xml',
+               max_age=100):
+    return '\r\n'.join([
+        'NOTIFY * HTTP/1.1',
+        'HOST: 239.255.255.250:1900',
+        'CACHE-CONTROL: max-age=%d' % max_age,
+        'LOCATION: %s' % location,
+        'NT: %s' % SERVICE,
+        'NTS: %s' % nts,
+        'USN: %s' % USN, '', ''])
+
+
+def test_notify_over_loopback(wait_for):
+    events = []
+    listener = ssdp.SSDPListener(SERVICE,
+                                 lambda event, response:
+                                 events.append((event, response)),
+                                 search_interval=3600)
+    listener.start()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        assert wait_for(lambda: hasattr(listener, 'sock'))
+        # The port is 1900 unless another process owns it
+        port = listener.sock.getsockname()[1]
+        sock.sendto(get_notify('ssdp:alive'), ('127.0.0.1', port))
+        sock.sendto(get_notify('ssdp:alive'), ('127.0.0.1', port))
+        sock.sendto(get_notify('ssdp:alive', location='http://other/'),
+                    ('127.0.0.1', port))
+        sock.sendto(get_notify('ssdp:byebye'), ('127.0.0.1', port))
+        assert wait_for(lambda: len(events) == 3)
+        assert [e for e, r in events] == ['alive', 'alive', 'byebye']
+        assert events[0][1].location == \
+            'http://192.168.0.2:80/description.xml'
+        assert events[0][1].get_max_age() == 100
+        assert events[1][1].location == 'http://other/'
+        assert listener.devices == {}
+    finally:
+        listener.inactivate()
+        sock.close()
+
+
+def test_search_response_is_parsed():
+    response = ssdp.SSDPResponse('\r\n'.join([
+        'HTTP/1.1 200 OK',
+        'CACHE-CONTROL: max-age=100',
+        'LOCATION: http://192.168.0.2:80/description.xml',
+        'ST: %s' % SERVICE,
+        'USN: %s' % USN, '', '']))
+    assert response.st == SERVICE
+    assert response.usn == USN
+    assert response.nts is None
+    assert response.get_max_age() == 100
+
+
+def test_devices_are_searched_within_their_max_age():
+    listener = ssdp.SSDPListener(SERVICE, lambda event, response: None,
+                                 search_interval=60)
+    assert listener.get_search_interval() == 60
+    listener._on_datagram(get_notify('ssdp:alive', max_age=100))
+    assert listener.get_search_interval() == 25
+
+
+def test_device_expires_after_missed_searches():
+    events = []
+    listener = ssdp.SSDPListener(SERVICE,
+                                 lambda event, response:
+                                 events.append(event),
+                                 search_interval=60)
+    listener._on_datagram(get_notify('ssdp:alive', max_age=100))
+    response, expires = listener.devices[USN]
+    # One response of M-SEARCH is lost
+    listener.devices[USN] = (response, time.time() - 25)
+    listener._expire()
+    assert events == ['alive']
+    listener.devices[USN] = (response, time.time() - 50)
+    listener._expire()
+    assert events == ['alive', 'expired']
+    assert listener.devices == {}